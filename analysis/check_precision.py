@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Check the likelihood kernels against a high precision reference.
+#
+# The recursions in household_likelihood.py lose precision to cancellation as
+# the number of cases in a household grows. They are meant to solve such
+# households again in extended precision, and to return an infinite negative
+# log likelihood rather than a wrong finite one only if too few digits are
+# left even then (see "Loss of precision" there). This solves the same
+# system with mpmath for households of 1 to 20 cases, at the centre of the
+# bounds of the fits, at the optima they have found and at random points
+# within the bounds: in 60 digits, as the reference, and in the 53 bits of a
+# double, to tell how accurate a double precision value can be. It fails on
+# every finite value the kernels return that is further from the reference
+# than they allow, and on every inf they return where the double precision
+# solution is accurate. It logs, for each number of cases, how many of the
+# values were finite and the largest error among them, then up to how many
+# cases the values at each point stay finite, and exits with status 1 if
+# there were any failures.
+
+import itertools
+import logging
+import pathlib
+import sys
+
+import mpmath
+import numpy as np
+
+from household_likelihood import (
+    ball_sorted_household_nll,
+    ball_sorted_household_nll_grad,
+    decimal_to_bit_array,
+    exchangeable_counts_nll,
+    exchangeable_household_nll_grad,
+    nll_tolerance,
+    submask_lattice,
+)
+
+homedir = pathlib.Path(__file__).resolve().parent.parent
+
+logging.basicConfig(
+    filename=homedir / "check_precision.log",
+    # stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s %(message)s",
+)
+logging.info("Libraries imported and logging started")
+
+nages = 2
+ncls = 2 ** nages
+qmax = 20
+ball_qmax = 14  # The Ball engine visits 3^q subset pairs
+
+# The kernels accept a value when their estimate of its error is within
+# nll_tolerance, and the estimate can fall short of the real error by a
+# small factor; they should only return inf for a household whose value
+# double precision cannot give to within nll_tolerance and extended
+# precision cannot either
+max_error = 10 * nll_tolerance
+accurate = nll_tolerance
+
+# Bounds as in opensafely_age_hh_th.py
+bb = np.array(
+    [[-3.0, -1.0], [-7.0, -3.0], [-10.0, 10.0], [-10.0, 10.0]]
+    + [[-3.0, 3.0]] * (3 * nages)
+)
+points = {
+    "centre": np.mean(bb, axis=1),
+    "ridge_0_0": np.array(
+        [-3.0, -4.51, -8.17, -0.28, -0.79, -0.25, -3.0, 1.11, -3.0, -3.0]
+    ),
+    "ridge_20_1": np.array(
+        [-1.0, -3.64, 0.05, -0.40, -0.34, -0.26, -0.05, -0.03, -0.03, 0.0]
+    ),
+}
+rng = np.random.default_rng(0)
+for p in range(0, 10):
+    points[f"random_{p}"] = rng.uniform(bb[:, 0], bb[:, 1])
+
+
+def reference_nll(n, q, x, prec=200):
+    # The Ball system over per-class case counts, as exchangeable_counts_nll
+    # solves it, without the scaling and in mpmath with prec bits
+    with mpmath.workprec(prec):
+        llaL, llaG, logtheta = (mpmath.mpf(float(v)) for v in x[:3])
+        eta = 4 / mpmath.pi * mpmath.atan(float(x[3]))
+        theta = mpmath.exp(logtheta)
+        lam = mpmath.exp(llaL) * mpmath.mpf(int(np.sum(n))) ** eta
+        log_escape, susceptibility, transmissibility = [], [], []
+        for c in range(0, ncls):
+            xc = decimal_to_bit_array(c, nages)
+            log_escape.append(-mpmath.exp(llaG + float(x[4 : (4 + nages)] @ xc)))
+            susceptibility.append(
+                mpmath.exp(float(x[(4 + nages) : (4 + 2 * nages)] @ xc))
+            )
+            transmissibility.append(mpmath.exp(float(x[(4 + 2 * nages) :] @ xc)))
+
+        P = {}
+        for a in itertools.product(*[range(0, qc + 1) for qc in q]):
+            S = sum((n[c] - a[c]) * susceptibility[c] for c in range(0, ncls))
+            B = mpmath.exp(sum((n[c] - a[c]) * log_escape[c] for c in range(0, ncls)))
+            phi = [
+                (1 + theta * lam * transmissibility[c] * S) ** (-1 / theta)
+                for c in range(0, ncls)
+            ]
+            total = B * mpmath.fprod(phi[c] ** a[c] for c in range(0, ncls))
+            for w in itertools.product(*[range(0, ac + 1) for ac in a]):
+                if w != a:
+                    total -= P[w] * mpmath.fprod(
+                        mpmath.binomial(a[c], w[c]) * phi[c] ** (a[c] - w[c])
+                        for c in range(0, ncls)
+                    )
+            P[a] = total
+        if P[tuple(q)] <= 0:
+            return np.inf  # Lost to cancellation at this precision
+        return float(-mpmath.log(P[tuple(q)]))
+
+
+def kernel_nlls(n, q, x):
+    # The negative log likelihood from each kernel that can take the household
+    eta = (4.0 / np.pi) * np.arctan(x[3])
+    alpha = x[4 : (4 + nages)]
+    beta = x[(4 + nages) : (4 + 2 * nages)]
+    gamma = x[(4 + 2 * nages) :]
+    ages = np.concatenate(
+        [np.full(n[c] - q[c], c) for c in range(0, ncls)]
+        + [np.full(q[c], c) for c in range(0, ncls)]
+    ).astype(np.uint8)
+    y = np.concatenate([np.zeros(np.sum(n) - np.sum(q)), np.ones(np.sum(q))])
+    nlls = {
+        "exchangeable": exchangeable_counts_nll(
+            n, q, x[0], x[1], x[2], eta, alpha, beta, gamma, nages
+        ),
+        "exchangeable_grad": exchangeable_household_nll_grad(
+            y, ages, x[0], x[1], x[2], eta, 1.0, alpha, beta, gamma, nages
+        )[0],
+    }
+    if np.sum(q) <= ball_qmax:
+        X = np.array([decimal_to_bit_array(c, nages) for c in ages])
+        lattice = submask_lattice(int(np.sum(q)))
+        args = (x[0], x[1], x[2], eta)
+        nlls["ball"] = ball_sorted_household_nll(
+            np.sum(q), X, lattice, *args, alpha, beta, gamma
+        )
+        nlls["ball_grad"] = ball_sorted_household_nll_grad(
+            np.sum(q), X, lattice, *args, 1.0, alpha, beta, gamma
+        )[0]
+    return nlls
+
+
+failures = 0
+valid_to = {name: 0 for name in points}  # Cases up to which all are finite
+for cases in range(1, qmax + 1):
+    # All the cases in one class, in a small and a large household, and the
+    # cases split between two classes
+    split = np.array([cases // 2, cases - cases // 2, 0, 0])
+    households = [
+        (np.array([cases + 1, 0, 0, 0]), np.array([cases, 0, 0, 0])),
+        (np.array([3 * cases, 0, 0, 0]), np.array([cases, 0, 0, 0])),
+        (split + np.array([1, 1, 1, 0]), split),
+    ]
+    finite = {}
+    worst = {}
+    all_finite = {name: True for name in points}
+    for n, q in households:
+        for name, x in points.items():
+            reference = reference_nll(n, q, x)
+            double_error = abs(reference_nll(n, q, x, 53) - reference)
+            for kernel, nll in kernel_nlls(n, q, x).items():
+                finite.setdefault(kernel, [0, 0])
+                finite[kernel][1] += 1
+                if not np.isfinite(nll):
+                    all_finite[name] = False
+                    if double_error <= accurate:
+                        failures += 1
+                        logging.info(
+                            "FAIL %s, members %s, cases %s, at %s: inf, but the "
+                            "double precision solution is within %.1e",
+                            kernel,
+                            n,
+                            q,
+                            name,
+                            double_error,
+                        )
+                    continue
+                finite[kernel][0] += 1
+                error = abs(nll - reference)
+                worst[kernel] = max(worst.get(kernel, 0.0), error)
+                if error > max_error:
+                    failures += 1
+                    logging.info(
+                        "FAIL %s, members %s, cases %s, at %s: %s, reference %s",
+                        kernel,
+                        n,
+                        q,
+                        name,
+                        nll,
+                        reference,
+                    )
+    for name in points:
+        if all_finite[name] and valid_to[name] == cases - 1:
+            valid_to[name] = cases
+    for kernel in finite:
+        logging.info(
+            "%2d cases, %-17s finite %3d/%3d, largest error %.1e",
+            cases,
+            kernel,
+            finite[kernel][0],
+            finite[kernel][1],
+            worst.get(kernel, 0.0),
+        )
+
+for name, x in points.items():
+    logging.info("Finite up to %2d cases at %-10s %s", valid_to[name], name, x)
+logging.info(
+    "%d values further than %.0e from the reference, or inf where a double is "
+    "within %.0e",
+    failures,
+    max_error,
+    accurate,
+)
+sys.exit(1 if failures else 0)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Checkpoints for long optimisation runs.
+#
+# A checkpoint is a small JSON file holding the state of one fit: where it
+# started, a hash of the model data and the model variant it fits, the
+# latest iterate, the best value seen and where, the number of
+# iterations and evaluations so far, the state of numpy's global random
+# number generator and, once the fit has finished, its result. The file is
+# rewritten at most every so many seconds from the optimiser callback,
+# through a temporary file so a job killed mid-write leaves the previous
+# checkpoint intact.
+#
+# scipy's optimisers cannot be restarted from their internal state, so a
+# resumed fit starts the optimiser afresh from the latest iterate; the
+# evaluation and iteration counts carry on from the checkpoint.
+
+import json
+import os
+import time
+
+import numpy as np
+
+
+def new_checkpoint(x0, data_sha256, variant):
+    return {
+        "x0": x0.tolist(),
+        "data_sha256": data_sha256,
+        "variant": variant,
+        "x": x0.tolist(),
+        "best_x": x0.tolist(),
+        "best_fun": np.inf,
+        "nit": 0,
+        "nfev": 0,
+        "rng_state": get_rng_state(),
+        "result": None,
+    }
+
+
+def load_checkpoint(path):
+    # The checkpoint in path, or None if there is none
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + ".partial")
+    with open(partial, "w") as f:
+        json.dump(state, f)
+    os.replace(partial, path)
+
+
+def get_rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+
+
+def set_rng_state(rng_state):
+    name, keys, pos, has_gauss, cached_gaussian = rng_state
+    keys = np.array(keys, dtype=np.uint32)
+    np.random.set_state((name, keys, pos, has_gauss, cached_gaussian))
+
+
+def checkpointed(objective, path, state, every=60.0, callback=None):
+    # Wraps objective, which returns the value or the value and gradient, so
+    # each evaluation is counted in state and the best point kept, and returns
+    # it with an optimiser callback that records each iterate, writes state to
+    # path if at least `every` seconds have passed since it was last written,
+    # and then calls callback
+    last_saved = time.monotonic()
+
+    def counted_objective(x, *args):
+        out = objective(x, *args)
+        fun = out[0] if isinstance(out, tuple) else out
+        state["nfev"] += 1
+        if fun < state["best_fun"]:
+            state["best_fun"] = float(fun)
+            state["best_x"] = x.tolist()
+        return out
+
+    def checkpoint_callback(x, *args):
+        nonlocal last_saved
+        state["x"] = x.tolist()
+        state["nit"] += 1
+        if time.monotonic() - last_saved >= every:
+            save_checkpoint(path, state)
+            last_saved = time.monotonic()
+        if callback is not None:
+            callback(x, *args)
+
+    return counted_objective, checkpoint_callback
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Compile the likelihood kernels into the on-disk cache ahead of the fits.
+#
+# Numba compiles a kernel for each combination of argument types it sees, so
+# the kernels are called here on a couple of made-up households with exactly
+# the types opensafely_age_hh_th.py loads from generate_model_data.py. Each
+# fit then loads the compiled kernels from output/numba_cache.
+
+import numpy as np
+import logging
+import numba
+import pathlib
+import tempfile
+import time
+
+from household_likelihood import (
+    ball_costs,
+    ball_nll,
+    ball_nll_batch,
+    ball_nll_grad,
+    cost_balanced_chunks,
+    exchangeable_costs,
+    exchangeable_nll,
+    exchangeable_nll_batch,
+    exchangeable_nll_grad,
+    kernel_cache_hits,
+    load_households,
+    log_phi,
+    phi,
+    submask_lattice,
+)
+
+homedir = pathlib.Path(__file__).resolve().parent.parent
+
+logging.basicConfig(
+    filename=homedir / "compile_kernels.log",
+    # stream=sys.stdout,
+    level=logging.INFO,
+    format="%(asctime)s %(message)s",
+)
+logging.info("Libraries imported and logging started")
+
+nages = 2
+add_ridge = 0.0
+x = np.zeros(4 + 3 * nages)
+
+# Two households written and read back the way generate_model_data.py and
+# load_households do it, so the kernels see memory-mapped read-only arrays
+with tempfile.TemporaryDirectory() as tmpdir:
+    np.save(f"{tmpdir}/household_cases.npy", np.array([0, 1, 1, 1], dtype=np.uint8))
+    np.save(f"{tmpdir}/household_ages.npy", np.array([0, 2, 1, 0], dtype=np.uint8))
+    np.save(f"{tmpdir}/household_offsets.npy", np.array([0, 3, 4], dtype=np.int64))
+    design = np.array([[0, 0], [1, 0], [0, 1], [0, 0]], dtype=np.uint8)
+    np.save(f"{tmpdir}/household_design.npy", design)
+    np.save(f"{tmpdir}/household_sizes.npy", np.array([3, 1], dtype=np.int64))
+    np.save(f"{tmpdir}/household_case_counts.npy", np.array([2, 1], dtype=np.int64))
+    np.save(f"{tmpdir}/household_counts.npy", np.ones(2, dtype=np.int64))
+    np.save(f"{tmpdir}/negative_age_totals.npy", np.zeros(3, dtype=np.int64))
+    households, W, N0 = load_households(tmpdir)
+
+start = time.perf_counter()
+sizes, q = households[4:]
+lattice = submask_lattice(int(np.max(q)))
+exchangeable_costs(households, nages)
+schedule = cost_balanced_chunks(ball_costs(sizes, q), 4)
+ball_nll(x, households, W, N0, nages, add_ridge, schedule, lattice)
+ball_nll_grad(x, households, W, N0, nages, add_ridge, schedule, lattice)
+exchangeable_nll(x, households, W, N0, nages, add_ridge, schedule)
+exchangeable_nll_grad(x, households, W, N0, nages, add_ridge, schedule)
+xs = np.vstack([x, x])
+ball_nll_batch(xs, households, W, N0, nages, add_ridge, schedule, lattice)
+exchangeable_nll_batch(xs, households, W, N0, nages, add_ridge, schedule)
+phi(1.0, 0.0)
+log_phi(1.0, 0.0)
+
+hits, misses = kernel_cache_hits(
+    ball_nll,
+    ball_nll_grad,
+    ball_nll_batch,
+    exchangeable_nll,
+    exchangeable_nll_grad,
+    exchangeable_nll_batch,
+    phi,
+)
+logging.info(
+    "Kernels ready in %.1f s (%s loaded from cache, %s compiled) in %s",
+    time.perf_counter() - start,
+    hits,
+    misses,
+    numba.config.CACHE_DIR,
+)
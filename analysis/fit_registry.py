@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# A local registry of fitted models, to warm-start new fits from.
+#
+# Each converged fit appends one JSON line to output/fit_registry.jsonl with
+# the optimum, its covariance (when the Hessian could be inverted), a hash of
+# the model data it was fitted to with a few summaries of that data, the
+# model variant and the bounds on the parameters. A new fit of the same
+# variant within the same bounds can then start from the optimum of the fit
+# whose data is nearest its own: the same data if it has been fitted before,
+# otherwise the fit whose household and people counts are closest, which
+# after a small refresh of the data is usually close to the new optimum.
+
+import datetime
+import hashlib
+import json
+import pathlib
+
+import numpy as np
+
+registry_path = pathlib.Path("output") / "fit_registry.jsonl"
+
+
+def data_digest(paths):
+    # sha256 over the contents of the files in paths, in the order given
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def data_distance(summary, other):
+    # How far apart two data sets are, going by the relative differences in
+    # their counts
+    a = np.array([summary["households"]] + summary["negative_age_totals"])
+    b = np.array([other["households"]] + other["negative_age_totals"])
+    if len(a) != len(b):
+        return np.inf
+    return float(np.sum(np.abs(np.log((a + 1.0) / (b + 1.0)))))
+
+
+def record_fit(entry, path=registry_path):
+    entry = {
+        **entry,
+        "recorded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def nearest_fit(data_sha256, data_summary, variant, bounds, path=registry_path):
+    # The registered fit of the same variant and bounds with the nearest data,
+    # the latest one if several are equally near, or None if there is none
+    try:
+        with open(path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    best, best_distance = None, np.inf
+    for entry in entries:
+        if entry["variant"] != variant or entry["bounds"] != bounds:
+            continue
+        if entry["data_sha256"] == data_sha256:
+            distance = 0.0
+        else:
+            distance = data_distance(data_summary, entry["data_summary"])
+        if np.isfinite(distance) and distance <= best_distance:
+            best, best_distance = entry, distance
+    return best
@@ -22,15 +22,35 @@ import scipy.optimize as op
 import pandas as pd
 from numpy import linalg as LA
 import matplotlib.pyplot as plt
-from tqdm.notebook import tqdm
 from collections import namedtuple
+import argparse
 import sys
 import pathlib
+import time
+
+from household_likelihood import (
+    ball_costs,
+    ball_household_nll,
+    cost_balanced_chunks,
+    group_by_household,
+    submask_lattice,
+    total_nll,
+)
+from hessian import covariance_from_hessian, finite_difference_hessian
+
+parser = argparse.ArgumentParser()
+parser.add_argument("nrestarts", nargs="?", type=int)
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=1,
+    help="Number of threads to spread the households over",
+)
+args = parser.parse_args()
 
-has_arguments = len(sys.argv) > 1
 nrestarts = 1
-if has_arguments:
-    nrestarts = int(sys.argv[1])
+if args.nrestarts is not None:
+    nrestarts = args.nrestarts
     sys.stdout = open("vo.txt", "w")
 
 
@@ -58,24 +78,9 @@ posi = (df["first_sampling"].values == "Positive") | (
 # In[5]:
 
 
-hcol = df.household_id.values
-hhids = pd.unique(df.household_id)
-num_households = len(hhids)
-
-
-# In[6]:
-
-
-household_tests = numba.typed.List()
-household_ages = numba.typed.List()
-for hid in hhids:
-    dfh = df[df.household_id == hid]
-    tests = (dfh["first_sampling"].values == "Positive") | (
-        dfh["second_sampling"].values == "Positive"
-    )
-    aa = dfh["age_group"].values
-    household_tests.append(tests)
-    household_ages.append(numba.typed.List(aa.to_list()))
+# Each household's rows in order, from one sort of the whole table
+order, offsets = group_by_household(df.household_id.values)
+num_households = len(offsets) - 1
 
 
 # In[7]:
@@ -96,12 +101,10 @@ positives_by_agegroup = np.zeros(len(age_gs))
 # In[9]:
 
 
-for i, ag in enumerate(age_gs):
-    dfa = df[df.age_group == ag]
-    counts_by_agegroup[i] = len(dfa)
-    dfp = df[posi]
-    dfa = dfp[dfp.age_group == ag]
-    positives_by_agegroup[i] = len(dfa)
+counts_by_agegroup[:] = df["age_group"].value_counts().reindex(age_gs)
+positives_by_agegroup[:] = (
+    df.loc[posi, "age_group"].value_counts().reindex(age_gs, fill_value=0)
+)
 
 
 # In[10]:
@@ -109,27 +112,24 @@ for i, ag in enumerate(age_gs):
 
 # Dictionary that puts ages in categories
 # 0 is reference class
-as2rg = numba.typed.Dict.empty(
-    key_type=numba.core.types.unicode_type, value_type=numba.core.types.int8
-)
-as2rg.update(
-    {
-        "00-10": 1,
-        "11-20": 1,
-        "21-30": 0,
-        "31-40": 0,
-        "41-50": 0,
-        "51-60": 0,
-        "61-70": 0,
-        "71-80": 0,
-        "81-90": 0,
-        "91+": 0,
-    }
-)
+as2rg = {
+    "00-10": 1,
+    "11-20": 1,
+    "21-30": 0,
+    "31-40": 0,
+    "41-50": 0,
+    "51-60": 0,
+    "61-70": 0,
+    "71-80": 0,
+    "81-90": 0,
+    "91+": 0,
+}
 # In[11]:
 
 
 na = max(as2rg.values())
+household_tests = posi[order]
+household_ages = df["age_group"].map(as2rg).to_numpy(dtype=np.uint8)[order]
 
 
 # In[12]:
@@ -138,25 +138,25 @@ na = max(as2rg.values())
 
 # XXX this might benefit from parallel=True when using larger datasets
 @numba.jit(nopython=True, cache=True, parallel=False)
-def get_storage_lists(as2rg, household_tests, household_ages):
+def get_storage_lists(household_tests, household_ages, offsets, na):
     Y = numba.typed.List()  # To store outcomes
     XX = numba.typed.List()  # To store design matrices
-    for i in range(0, num_households):
-        mya = [as2rg[a] for a in household_ages[i]]
+    for i in range(0, len(offsets) - 1):
+        mya = household_ages[offsets[i] : offsets[i + 1]]
         m = len(mya)
-        myx = np.zeros((m, na))
-        myy = np.zeros(m)
+        myx = np.zeros((m, na), dtype=np.uint8)
+        myy = np.zeros(m, dtype=np.uint8)
         for j, a in enumerate(mya):
             if a > 0:
                 myx[j, a - 1] = 1
-            if household_tests[i][j]:
+            if household_tests[offsets[i] + j]:
                 myy[j] = 1
         Y.append(myy)
         XX.append(np.atleast_2d(myx))
     return Y, XX
 
 
-Y, XX = get_storage_lists(as2rg, household_tests, household_ages)
+Y, XX = get_storage_lists(household_tests, household_ages, offsets, na)
 
 # In[13]:
 
@@ -199,7 +199,7 @@ x = np.array(
 
 
 @numba.jit(nopython=True, cache=True)
-def firstnll(Y, XX):
+def firstnll(x, Y, XX, na):
     llaL = x[0]
     llaG = x[1]
     logtheta = x[2]
@@ -208,10 +208,10 @@ def firstnll(Y, XX):
     beta = x[(4 + na) : (4 + 2 * na)]
     gamma = x[(4 + 2 * na) :]
 
-    nlv = np.zeros(num_households)  # Vector of negative log likelihoods
-    for i in range(0, num_households):
+    nlv = np.zeros(len(Y))  # Vector of negative log likelihoods
+    for i in range(0, len(Y)):
         y = Y[i]
-        X = XX[i]
+        X = XX[i].astype(np.float64)
         if np.all(y == 0.0):
             nlv[i] = np.exp(llaG) * np.sum(np.exp(alpha @ (X.T)))
         else:
@@ -243,7 +243,7 @@ def firstnll(Y, XX):
     return nll, r, m
 
 
-nll, r, m = firstnll(Y, XX)
+nll, r, m = firstnll(x, Y, XX, na)
 # In[ ]:
 
 
@@ -270,57 +270,47 @@ om >= j
 # In[19]:
 
 
-@numba.jit(nopython=True, parallel=False, fastmath=False, cache=True)
+# Households are dealt out to the threads in chunks of similar expected cost
+numba.set_num_threads(args.threads)
+q = np.array([np.sum(y > 0) for y in Y])
+costs = ball_costs([len(y) for y in Y], q)
+schedule = cost_balanced_chunks(costs, 4 * args.threads)
+lattice = submask_lattice(int(np.max(q)))
+
+
+@numba.jit(nopython=True, parallel=True, fastmath=False, cache=True)
+def nll_kernel(x, Y, XX, na, schedule, lattice):
+    order, bounds = schedule
+    llaL = x[0]
+    llaG = x[1]
+    logtheta = x[2]
+    eta = (4.0 / np.pi) * np.arctan(x[3])
+    alpha = x[4 : (4 + na)]
+    beta = x[(4 + na) : (4 + 2 * na)]
+    gamma = x[(4 + 2 * na) :]
+
+    nlv = np.zeros(len(Y))  # Vector of negative log likelihoods
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            nlv[i] = ball_household_nll(
+                Y[i],
+                XX[i].astype(np.float64),
+                lattice,
+                llaL,
+                llaG,
+                logtheta,
+                eta,
+                alpha,
+                beta,
+                gamma,
+            )
+    # Every household counts once; add a Ridge if needed (was 7.4)
+    return total_nll(x, np.ones(len(Y)), nlv, 1.0)
+
+
 def mynll(x, Y, XX):
-    if True:  # Ideally catch the linear algebra fail directly
-        llaL = x[0]
-        llaG = x[1]
-        logtheta = x[2]
-        eta = (4.0 / np.pi) * np.arctan(x[3])
-        alpha = x[4 : (4 + na)]
-        beta = x[(4 + na) : (4 + 2 * na)]
-        gamma = x[(4 + 2 * na) :]
-
-        nlv = np.zeros(num_households)  # Vector of negative log likelihoods
-        for i in range(0, num_households):
-            y = Y[i]
-            X = XX[i]
-            if np.all(y == 0.0):
-                nlv[i] = np.exp(llaG) * np.sum(np.exp(alpha @ (X.T)))
-            else:
-                # Sort to go zeros then ones WLOG (could do in pre-processing)
-                ii = np.argsort(y)
-                y = y[ii]
-                X = X[ii, :]
-                q = np.sum(y > 0)
-                r = 2 ** q
-                m = len(y)
-
-                # Quantities that don't vary through the sum
-                Bk = np.exp(-np.exp(llaG) * np.exp(alpha @ (X.T)))
-                laM = np.exp(llaL) * np.outer(
-                    np.exp(beta @ (X.T)), np.exp(gamma @ (X.T))
-                )
-                laM *= m ** eta
-
-                BB = np.zeros((r, r))  # To be the Ball matrix
-                for jd in range(0, r):
-                    j = decimal_to_bit_array(jd, m)
-                    for omd in range(0, jd + 1):
-                        om = decimal_to_bit_array(omd, m)
-                        if np.all(om <= j):
-                            BB[jd, omd] = 1.0 / np.prod(
-                                (phi((1 - j) @ laM, logtheta) ** om) * (Bk ** (1 - j))
-                            )
-                nlv[i] = -np.log(LA.solve(BB, np.ones(r))[-1])
-        nll = np.sum(nlv)
-        # nll += 7.4*np.sum(x**2) # Add a Ridge if needed
-        nll += np.sum(x ** 2)  # Add a Ridge if needed
-        return nll
-    else:
-        # This was a try/except block but these are not supported by numba. TODO: work out and implement correct branching logic
-        nll = np.inf
-        return nll
+    return nll_kernel(x, Y, XX, na, schedule, lattice)
 
 
 # In[20]:
@@ -338,7 +328,9 @@ x0 = np.array(
         0.0,
     ]
 )
+start = time.perf_counter()
 mynll(x0, Y, XX)
+print("Startup took {:.1f} s".format(time.perf_counter() - start))
 
 
 # In[21]:
@@ -444,38 +436,19 @@ print(xhat)
 # In[28]:
 
 
-pn = len(x0)
 delta = (
     1e-2  # This will need some tuning, but here set at sqrt(default delta in optimiser)
 )
 dx = delta * xhat
-ej = np.zeros(pn)
-ek = np.zeros(pn)
-Hinv = np.zeros((pn, pn))
-for j in tqdm(range(0, pn)):
-    ej[j] = dx[j]
-    for k in range(0, j):
-        ek[k] = dx[k]
-        Hinv[j, k] = (
-            mynll(xhat + ej + ek, Y, XX)
-            - mynll(xhat + ej - ek, Y, XX)
-            - mynll(xhat - ej + ek, Y, XX)
-            + mynll(xhat - ej - ek, Y, XX)
-        )
-        ek[k] = 0.0
-    Hinv[j, j] = (
-        -mynll(xhat + 2 * ej, Y, XX)
-        + 16 * mynll(xhat + ej, Y, XX)
-        - 30 * mynll(xhat, Y, XX)
-        + 16 * mynll(xhat - ej, Y, XX)
-        - mynll(xhat - 2 * ej, Y, XX)
-    )
-    ej[j] = 0.0
-Hinv += np.triu(Hinv.T, 1)
-Hinv /= 4.0 * np.outer(dx, dx) + np.diag(
-    8.0 * dx ** 2
-)  # TO DO: replace with a chol ...
-covmat = LA.inv(0.5 * (Hinv + Hinv.T))
+# Each distinct point of the stencil is evaluated once, the households
+# spread over the threads at each
+Hinv = finite_difference_hessian(lambda x: mynll(x, Y, XX), xhat, dx)
+try:
+    covmat = covariance_from_hessian(Hinv)
+except np.linalg.LinAlgError:
+    print("Matrix is singular or ill-conditioned. Exiting.")
+    print(Hinv + Hinv.T)
+    sys.exit(0)
 stds = np.sqrt(np.diag(covmat))
 stds
 
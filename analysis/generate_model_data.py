@@ -11,10 +11,18 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import logging
 import numba
+import argparse
+import datetime
+import hashlib
+import json
 import os
+import shutil
 import sys
 import pathlib
 import pickle
+import time
+
+import synthetic_households
 
 
 homedir = pathlib.Path(__file__).resolve().parent.parent
@@ -27,10 +35,33 @@ logging.basicConfig(
 )
 logging.info("Libraries imported and logging started")
 
+# Age bands and the bitmask code used for each by the fitting scripts
+age_bins = [-1, 9, 18, 200]
+age_bitmasks = [2, 1, 0]
+
+dataset = "./output/hh_analysis_dataset.dta"
+cohort = "./output/input.csv"
+
+# Everything write_outputs produces, each saved as output/<name>.npy
+output_names = [
+    "household_cases",
+    "household_ages",
+    "household_offsets",
+    "household_design",
+    "household_sizes",
+    "household_case_counts",
+    "household_counts",
+    "negative_age_totals",
+]
+
+# Built outputs are kept under the hash of what went into them, so running
+# the action again on the same dataset only copies them back into output/
+model_data_cache_dir = homedir / "output" / "model_data_cache"
+
 
 def get_df():
     if "test_data" not in sys.argv:
-        df = pd.read_stata("./output/hh_analysis_dataset.dta", columns=["hh_id", "age", "case"])
+        df = pd.read_stata(dataset, columns=["hh_id", "age", "case"])
     else:
         # test data
         np.random.seed(42)
@@ -53,28 +84,510 @@ def get_df():
 
 
 def get_storage_lists(df):
-    age_bins = [-1, 9, 18, 200]
-    age_bitmasks = [2, 1, 0]
     # The following is a hack around us getting impossible ages
     df = df[df.age >= 0]
     df["age_labels"] = pd.cut(df["age"], bins=age_bins, labels=age_bitmasks, right=True)
     # As a result of the age >=0 hack, we expect the following assertion always
     # to pass
     assert ~np.any(np.isnan(list(df.age_labels.values))), "Unbinnable age found!"
+    # One byte per case flag and age code from here on
+    df["age_labels"] = df["age_labels"].astype(np.uint8)
+    df["case"] = (df["case"] > 0).astype(np.uint8)
     grouped = df.groupby("hh_id")
     cases = grouped["case"].apply(np.array)
     age_categories = grouped["age_labels"].apply(np.array)
     return cases.to_numpy(), age_categories.to_numpy()
 
 
-def write_outputs():
-    cases, age_categories = get_storage_lists(get_df())
-    with open("output/case_series.pickle", "wb") as f:
-        pickle.dump(cases, f)
-    with open("output/age_categories_series.pickle", "wb") as f:
-        pickle.dump(age_categories, f)
+def compress_households(cases, age_categories):
+    # Household members are exchangeable in the model, so put each household
+    # into a canonical order (negatives first, then by age category) and store
+    # each distinct (case vector, age vector) pattern once with a count of the
+    # households that share it.
+    pattern_index = {}
+    pattern_cases = []
+    pattern_ages = []
+    counts = []
+    for y, a in zip(cases, age_categories):
+        y = np.asarray(y, dtype=np.uint8)
+        a = np.asarray(a, dtype=np.uint8)
+        ii = np.lexsort((a, y))
+        y = y[ii]
+        a = a[ii]
+        key = (y.tobytes(), a.tobytes())
+        if key in pattern_index:
+            counts[pattern_index[key]] += 1
+        else:
+            pattern_index[key] = len(counts)
+            pattern_cases.append(y)
+            pattern_ages.append(a)
+            counts.append(1)
+
+    unique_cases = np.empty(len(counts), dtype=object)
+    unique_ages = np.empty(len(counts), dtype=object)
+    for i in range(len(counts)):
+        unique_cases[i] = pattern_cases[i]
+        unique_ages[i] = pattern_ages[i]
+    return unique_cases, unique_ages, np.array(counts, dtype=np.int64)
+
+
+def split_negative_households(cases, age_categories, counts):
+    # A household without cases only contributes the probability that none of
+    # its members was infected from the community, which depends on nothing
+    # but how many of them fall in each age category. Those households are
+    # reduced to per-category member totals and dropped from the patterns.
+    has_case = np.array([np.any(y > 0) for y in cases], dtype=bool)
+    negative_totals = np.zeros(max(age_bitmasks) + 1, dtype=np.int64)
+    for a, n in zip(age_categories[~has_case], counts[~has_case]):
+        negative_totals += n * np.bincount(a, minlength=len(negative_totals))
+    return (
+        cases[has_case],
+        age_categories[has_case],
+        counts[has_case],
+        negative_totals,
+    )
+
+
+def get_chunks(chunksize):
+    # The same rows as get_df, chunksize rows at a time
+    if "test_data" in sys.argv:
+        df = get_df()
+        for start in range(0, len(df), chunksize):
+            yield df.iloc[start : start + chunksize]
+        return
+    with pd.read_stata(
+        dataset,
+        columns=["hh_id", "age", "case"],
+        iterator=True,
+        chunksize=chunksize,
+    ) as reader:
+        for chunk in reader:
+            yield chunk
+    logging.info("Data Read In")
+
+
+def get_cohort_chunks(path, chunksize):
+    # Rows with the same hh_id, age and case columns as the analysis dataset,
+    # straight from the cohortextractor output and chunksize rows at a time,
+    # so the model data can be built without the Stata prep stage. Cases are
+    # people with a positive SGSS test; the do-file's other case sources
+    # (primary care, hospital admissions, death certificates) are not used.
+    # The do-file's exclusions that bear on the model are applied: people in
+    # care homes, households of one or of more than ten, ages over 105, sex
+    # other than M or F and cases dated before 2020.
+    columns = [
+        "household_id",
+        "household_size",
+        "age",
+        "sex",
+        "care_home_type",
+        "first_positive_test_date",
+    ]
+    reader = pd.read_csv(
+        path,
+        usecols=columns,
+        dtype={
+            "sex": "category",
+            "care_home_type": "category",
+            "first_positive_test_date": str,
+        },
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        # Dates are YYYY-MM-DD, so they compare as strings
+        positive = chunk["first_positive_test_date"].fillna("")
+        keep = (
+            (chunk["care_home_type"] == "U")
+            & chunk["household_size"].between(2, 10)
+            & (chunk["age"] <= 105)
+            & chunk["sex"].isin(["M", "F"])
+            & ((positive == "") | (positive >= "2020-01-01"))
+        )
+        yield pd.DataFrame(
+            {
+                "hh_id": chunk.loc[keep, "household_id"],
+                "age": chunk.loc[keep, "age"],
+                "case": (positive[keep] != "").astype(np.int64),
+            }
+        )
+    logging.info("Data Read In")
+
+
+def tally_households(chunks):
+    # As far as the model is concerned a household is just the number of its
+    # members in each (case, age category) cell, so the rows are folded into
+    # one row of cell counts per household as they are read, with cell
+    # case * n_codes + age code. The file is sorted by patient rather than
+    # household, so a household's members can turn up in any chunk; only the
+    # current chunk and the table of counts are held in memory.
+    n_codes = max(age_bitmasks) + 1
+    hh_ids = np.zeros(0, dtype=np.int64)
+    tallies = np.zeros((0, 2 * n_codes), dtype=np.int32)
+    for chunk in chunks:
+        # The same hack around impossible ages as in get_storage_lists
+        chunk = chunk[chunk.age >= 0]
+        codes = pd.cut(chunk["age"], bins=age_bins, labels=age_bitmasks, right=True)
+        assert ~np.any(codes.isna()), "Unbinnable age found!"
+        cells = np.asarray(codes, dtype=np.int64)
+        cells += n_codes * (chunk["case"].to_numpy() > 0)
+        chunk_ids, rows = np.unique(chunk["hh_id"].to_numpy(), return_inverse=True)
+        chunk_tallies = np.zeros((len(chunk_ids), tallies.shape[1]), dtype=np.int32)
+        np.add.at(chunk_tallies, (rows, cells), 1)
+
+        merged_ids = np.union1d(hh_ids, chunk_ids)
+        merged = np.zeros((len(merged_ids), tallies.shape[1]), dtype=np.int32)
+        merged[np.searchsorted(merged_ids, hh_ids)] = tallies
+        merged[np.searchsorted(merged_ids, chunk_ids)] += chunk_tallies
+        hh_ids, tallies = merged_ids, merged
+    logging.info("%s households tallied", len(hh_ids))
+    return tallies
+
+
+def unique_rows(rows, weights=None):
+    # Distinct rows of a table of counts in lexicographic order, with their
+    # numbers of occurrences (or sums of weights), as from np.unique(rows,
+    # axis=0, return_counts=True). Each row is packed into one int64 with the
+    # first column in the top bits, so a plain sort of the keys does the work
+    # of the much slower sort of whole rows.
+    bits = max(int(rows.max(initial=0)).bit_length(), 1)
+    if bits * rows.shape[1] > 63:
+        patterns, rows_index = np.unique(rows, axis=0, return_inverse=True)
+    else:
+        shifts = bits * np.arange(rows.shape[1])[::-1]
+        keys = np.bitwise_or.reduce(rows.astype(np.int64) << shifts, axis=1)
+        _, first, rows_index = np.unique(keys, return_index=True, return_inverse=True)
+        patterns = rows[first]
+    counts = np.bincount(rows_index.ravel(), weights=weights, minlength=len(patterns))
+    return patterns, counts.astype(np.int64)
+
+
+def compress_tallies(tallies):
+    # The same patterns as compress_households, from the per-household cell
+    # counts: cells are in the canonical order already (negatives first, then
+    # by age category), so each distinct row of counts is one pattern
+    patterns, counts = unique_rows(tallies)
+    return expand_patterns(patterns, counts)
+
+
+def synthetic_patterns(n_people, seed, attack_rate, care_homes=False):
+    # Distinct rows of cell counts and their numbers of households, for
+    # households from synthetic_households rather than the dataset. Each
+    # batch is reduced to its own distinct rows before they are merged, so
+    # only one batch of households is in memory at a time. As in the
+    # dataset, households of one or of more than ten are left out, which
+    # leaves out the care homes too unless care_homes is set; with them,
+    # households of up to 80 members and dozens of cases are kept.
+    n_codes = max(age_bitmasks) + 1
+    patterns = np.zeros((0, 2 * n_codes), dtype=np.int32)
+    counts = np.zeros(0, dtype=np.int64)
+    batches = synthetic_households.household_batches(
+        n_people, seed=seed, attack_rate=attack_rate
+    )
+    n_dropped = 0
+    for members, cases in batches:
+        size = np.sum(members, axis=1)
+        keep = (size >= 2) & ((size <= 10) | care_homes)
+        n_dropped += np.sum(~keep)
+        members, cases = members[keep], cases[keep]
+        tallies = np.zeros((len(members), 2 * n_codes), dtype=np.int32)
+        for band, code in enumerate(age_bitmasks):
+            tallies[:, code] = members[:, band] - cases[:, band]
+            tallies[:, n_codes + code] = cases[:, band]
+        batch_patterns, batch_counts = unique_rows(tallies)
+        patterns, counts = unique_rows(
+            np.concatenate([patterns, batch_patterns]),
+            weights=np.concatenate([counts, batch_counts]),
+        )
+    logging.info(
+        "%s synthetic people generated, %s households left out", n_people, n_dropped
+    )
+    return patterns, counts
+
+
+def expand_patterns(patterns, counts):
+    # Case and age vectors of each distinct row of cell counts
+    n_codes = patterns.shape[1] // 2
+    cells = np.arange(patterns.shape[1])
+    unique_cases = np.empty(len(counts), dtype=object)
+    unique_ages = np.empty(len(counts), dtype=object)
+    for i in range(len(counts)):
+        unique_cases[i] = np.repeat(cells // n_codes, patterns[i]).astype(np.uint8)
+        unique_ages[i] = np.repeat(cells % n_codes, patterns[i]).astype(np.uint8)
+    return unique_cases, unique_ages, counts.astype(np.int64)
+
+
+def to_flat_arrays(cases, age_categories):
+    # One uint8 case flag and one uint8 age code per person, households one
+    # after another, with household i in [offsets[i], offsets[i + 1])
+    sizes = np.array([len(y) for y in cases], dtype=np.int64)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    flat_cases = np.zeros(offsets[-1], dtype=np.uint8)
+    flat_ages = np.zeros(offsets[-1], dtype=np.uint8)
+    for i, (y, a) in enumerate(zip(cases, age_categories)):
+        flat_cases[offsets[i] : offsets[i + 1]] = y > 0
+        flat_ages[offsets[i] : offsets[i + 1]] = a
+    return flat_cases, flat_ages, offsets
+
+
+def design_arrays(flat_cases, flat_ages, offsets):
+    # What the likelihood needs of each household besides its case flags,
+    # worked out once here rather than on every evaluation: each member's
+    # age bitmask as a row of the design matrix (one column per bit, most
+    # significant first), and the members and cases of each household. The
+    # kernels rely on each household's cases coming after its negatives,
+    # which the canonical order guarantees.
+    starts = np.zeros(len(flat_cases), dtype=bool)
+    starts[offsets[:-1]] = True
+    in_order = starts[1:] | (flat_cases[1:] >= flat_cases[:-1])
+    assert np.all(in_order), "Household with a case before a negative"
+    nages = max(age_bitmasks).bit_length()
+    shifts = np.arange(nages)[::-1]
+    design = ((flat_ages[:, None].astype(np.int64) >> shifts) & 1).astype(np.uint8)
+    sizes = np.diff(offsets)
+    cumulative_cases = np.zeros(len(flat_cases) + 1, dtype=np.int64)
+    np.cumsum(flat_cases, out=cumulative_cases[1:])
+    case_counts = cumulative_cases[offsets[1:]] - cumulative_cases[offsets[:-1]]
+    return design, sizes, case_counts
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def input_digest(synthetic=None, input_csv=None):
+    # Generated data comes from a fixed seed, so the settings and generator
+    # stand in for the contents
+    if synthetic is not None:
+        h = hashlib.sha256(json.dumps(synthetic, sort_keys=True).encode())
+        h.update(file_digest(synthetic_households.__file__).encode())
+        return h.hexdigest()
+    if "test_data" in sys.argv:
+        return hashlib.sha256(b"test_data").hexdigest()
+    if input_csv is not None:
+        return file_digest(input_csv)
+    return file_digest(dataset)
+
+
+def input_name(synthetic=None, input_csv=None):
+    if synthetic is not None:
+        return "synthetic"
+    if "test_data" in sys.argv:
+        return "test_data"
+    return dataset if input_csv is None else str(input_csv)
+
+
+def cache_key(input_hash):
+    # The outputs depend on the dataset, the age binning and the code in this
+    # file that turns one into the other
+    h = hashlib.sha256()
+    h.update(input_hash.encode())
+    h.update(json.dumps({"age_bins": age_bins, "age_bitmasks": age_bitmasks}).encode())
+    h.update(file_digest(__file__).encode())
+    return h.hexdigest()
+
+
+def build_outputs(chunksize=None, synthetic=None, input_csv=None):
+    # Returns the arrays named in output_names and the number of households
+    if synthetic is not None:
+        patterns, counts = synthetic_patterns(**synthetic)
+        cases, age_categories, counts = expand_patterns(patterns, counts)
+    elif input_csv is not None and "test_data" not in sys.argv:
+        chunks = get_cohort_chunks(input_csv, chunksize or 1_000_000)
+        cases, age_categories, counts = compress_tallies(tally_households(chunks))
+    elif chunksize is None:
+        cases, age_categories = get_storage_lists(get_df())
+        cases, age_categories, counts = compress_households(cases, age_categories)
+    else:
+        tallies = tally_households(get_chunks(chunksize))
+        cases, age_categories, counts = compress_tallies(tallies)
+    n_households = int(counts.sum())
+    logging.info(
+        "%s households compressed to %s distinct patterns", n_households, len(counts)
+    )
+    cases, age_categories, counts, negative_totals = split_negative_households(
+        cases, age_categories, counts
+    )
+    logging.info(
+        "%s households with cases kept as %s patterns; members of households "
+        "without cases by age category: %s",
+        counts.sum(),
+        len(counts),
+        negative_totals,
+    )
+    flat_cases, flat_ages, offsets = to_flat_arrays(cases, age_categories)
+    design, sizes, case_counts = design_arrays(flat_cases, flat_ages, offsets)
+    arrays = {
+        "household_cases": flat_cases,
+        "household_ages": flat_ages,
+        "household_offsets": offsets,
+        "household_design": design,
+        "household_sizes": sizes,
+        "household_case_counts": case_counts,
+        "household_counts": counts,
+        "negative_age_totals": negative_totals,
+    }
+    return arrays, n_households
+
+
+def write_outputs(chunksize=None, rebuild=False, synthetic=None, input_csv=None):
+    # synthetic, if given, holds the arguments of synthetic_patterns and
+    # replaces the dataset; input_csv, if given, is a cohortextractor output
+    # read in place of the dataset
+    input_hash = input_digest(synthetic, input_csv)
+    key = cache_key(input_hash)
+    entry = model_data_cache_dir / key
+    if rebuild or not (entry / "manifest.json").exists():
+        start = time.perf_counter()
+        arrays, n_households = build_outputs(chunksize, synthetic, input_csv)
+        # Written beside the entry and renamed into place, so an interrupted
+        # build never leaves a partial entry behind
+        partial = model_data_cache_dir / f"{key}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        partial.mkdir(parents=True)
+        for name in output_names:
+            np.save(partial / f"{name}.npy", arrays[name])
+        manifest = {
+            "key": key,
+            "input": input_name(synthetic, input_csv),
+            "input_sha256": input_hash,
+            "age_bins": age_bins,
+            "age_bitmasks": age_bitmasks,
+            "households": n_households,
+            "patterns": len(arrays["household_counts"]),
+            "built_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "build_seconds": round(time.perf_counter() - start, 3),
+        }
+        with open(partial / "manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        shutil.rmtree(entry, ignore_errors=True)
+        partial.rename(entry)
+        logging.info("Model data built and cached in %s", entry)
+    else:
+        with open(entry / "manifest.json") as f:
+            manifest = json.load(f)
+        logging.info(
+            "Reusing model data for %s households built at %s from %s",
+            manifest["households"],
+            manifest["built_at"],
+            entry,
+        )
+    for name in output_names:
+        shutil.copyfile(entry / f"{name}.npy", f"output/{name}.npy")
+
+
+def write_shards(directory="output"):
+    # Splits the patterns in directory by household size and number of cases
+    # into directory/shards/<name>/, each a complete household store with a
+    # shard.json describing it. The shards are listed in index.json, smallest
+    # households first, and the members of households without cases are
+    # copied alongside since they belong to no shard.
+    directory = pathlib.Path(directory)
+    arrays = {name: np.load(directory / f"{name}.npy") for name in output_names}
+    sizes = arrays["household_sizes"]
+    case_counts = arrays["household_case_counts"]
+    shards_dir = directory / "shards"
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    shards_dir.mkdir(parents=True)
+    names = []
+    for m, q in sorted(set(zip(sizes.tolist(), case_counts.tolist()))):
+        patterns = np.flatnonzero((sizes == m) & (case_counts == q))
+        # Every household in the shard has m members
+        rows = (arrays["household_offsets"][patterns][:, None] + np.arange(m)).ravel()
+        shard = {
+            "household_cases": arrays["household_cases"][rows],
+            "household_ages": arrays["household_ages"][rows],
+            "household_offsets": m * np.arange(len(patterns) + 1, dtype=np.int64),
+            "household_design": arrays["household_design"][rows],
+            "household_sizes": sizes[patterns],
+            "household_case_counts": case_counts[patterns],
+            "household_counts": arrays["household_counts"][patterns],
+        }
+        name = f"size{m:02d}_cases{q:02d}"
+        (shards_dir / name).mkdir()
+        for array_name, array in shard.items():
+            np.save(shards_dir / name / f"{array_name}.npy", array)
+        meta = {
+            "name": name,
+            "size": m,
+            "cases": q,
+            "patterns": len(patterns),
+            "households": int(shard["household_counts"].sum()),
+        }
+        with open(shards_dir / name / "shard.json", "w") as f:
+            json.dump(meta, f, indent=2)
+        names.append(name)
+    np.save(shards_dir / "negative_age_totals.npy", arrays["negative_age_totals"])
+    with open(shards_dir / "index.json", "w") as f:
+        json.dump({"shards": names}, f, indent=2)
+    logging.info("%s shards written to %s", len(names), shards_dir)
 
 
 if __name__ == "__main__":
-    write_outputs()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("test_data", nargs="?", choices=["test_data"])
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Stream the dataset this many rows at a time instead of reading it whole",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build the outputs even if they are cached for this dataset",
+    )
+    parser.add_argument(
+        "--input-csv",
+        nargs="?",
+        const=cohort,
+        metavar="PATH",
+        help="Read the cohortextractor output (by default %(const)s) instead of the "
+        "Stata analysis dataset",
+    )
+    parser.add_argument(
+        "--shards",
+        action="store_true",
+        help="Also write the households split by size and number of cases",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="PEOPLE",
+        help="Generate this many people in synthetic households instead of reading "
+        "the dataset",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for the synthetic households"
+    )
+    parser.add_argument(
+        "--attack-rate",
+        type=float,
+        default=0.02,
+        help="Probability that a synthetic person is infected from the community",
+    )
+    parser.add_argument(
+        "--care-homes",
+        action="store_true",
+        help="Keep the synthetic care homes, which the dataset leaves out. Their "
+        "outbreaks have too many cases for either likelihood engine, so fit such "
+        "data with --shards and --max-shard-cases",
+    )
+    args = parser.parse_args()
+    if args.care_homes and args.synthetic is None:
+        parser.error("--care-homes needs --synthetic")
+    synthetic = None
+    if args.synthetic is not None:
+        synthetic = {
+            "n_people": args.synthetic,
+            "seed": args.seed,
+            "attack_rate": args.attack_rate,
+            "care_homes": args.care_homes,
+        }
+    write_outputs(args.chunksize, args.rebuild, synthetic, args.input_csv)
+    if args.shards:
+        write_shards("output")
     logging.info("Final format data created")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Finite difference Hessians of the negative log likelihood at an optimum,
+# and the covariance of the estimates from them.
+#
+# The second derivatives use the five point formula on the diagonal and the
+# four point cross formula off it, with step dx[j] in parameter j:
+#
+#   H_jj = (-f(+2e_j) + 16 f(+e_j) - 30 f(0) + 16 f(-e_j) - f(-2e_j)) / (12 dx_j^2)
+#   H_jk = (f(+e_j+e_k) - f(+e_j-e_k) - f(-e_j+e_k) + f(-e_j-e_k)) / (4 dx_j dx_k)
+#
+# All the points are laid out first and the repeats among them (the centre
+# point appears in every diagonal term) taken out, so each is evaluated once,
+# either one at a time or in one call to a batch kernel that shares a single
+# pass over the households between all of them.
+
+import numpy as np
+import scipy.linalg
+
+
+def hessian_stencil(xhat, dx):
+    # The points of the stencil in the order hessian_from_values takes their
+    # values: for each j, the four cross terms with each k < j, then the five
+    # diagonal terms
+    pn = len(xhat)
+    ej = np.zeros(pn)
+    ek = np.zeros(pn)
+    stencil = []
+    for j in range(0, pn):
+        ej[j] = dx[j]
+        for k in range(0, j):
+            ek[k] = dx[k]
+            stencil += [xhat + ej + ek, xhat + ej - ek, xhat - ej + ek, xhat - ej - ek]
+            ek[k] = 0.0
+        stencil += [xhat + 2 * ej, xhat + ej, xhat, xhat - ej, xhat - 2 * ej]
+        ej[j] = 0.0
+    return np.array(stencil)
+
+
+def hessian_from_values(fvals, dx):
+    # The Hessian from the values at the points of hessian_stencil
+    pn = len(dx)
+    fvals = iter(fvals)
+    H = np.zeros((pn, pn))
+    for j in range(0, pn):
+        for k in range(0, j):
+            fpp, fpm, fmp, fmm = [next(fvals) for _ in range(4)]
+            H[j, k] = fpp - fpm - fmp + fmm
+        f2p, f1p, f0, f1m, f2m = [next(fvals) for _ in range(5)]
+        H[j, j] = -f2p + 16 * f1p - 30 * f0 + 16 * f1m - f2m
+    H += np.triu(H.T, 1)
+    return H / (4.0 * np.outer(dx, dx) + np.diag(8.0 * dx ** 2))
+
+
+def finite_difference_hessian(nll, xhat, dx, batch=False):
+    # The Hessian of nll at xhat. nll takes a point, or with batch an array
+    # with one point per row and returns the values at all of them.
+    stencil = hessian_stencil(xhat, dx)
+    points, inverse = np.unique(stencil, axis=0, return_inverse=True)
+    if batch:
+        values = np.asarray(nll(points))
+    else:
+        values = np.array([nll(x) for x in points])
+    return hessian_from_values(values[inverse.ravel()], dx)
+
+
+def covariance_from_hessian(H):
+    # The inverse of the symmetric part of H through its Cholesky factor.
+    # Raises numpy.linalg.LinAlgError if H is not positive definite, which at
+    # a true interior minimum it is.
+    factor = scipy.linalg.cho_factor(0.5 * (H + H.T))
+    return scipy.linalg.cho_solve(factor, np.eye(len(H)))
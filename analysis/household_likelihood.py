@@ -0,0 +1,1488 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Household final size likelihood engines for opensafely_age_hh_th.py
+#
+# Both engines compute the same negative log likelihood:
+#
+# * ball_nll solves the Ball system over every subset of the infected members
+#   of a household, so a household with q cases costs 2^q x 2^q
+# * exchangeable_nll uses the fact that members of the same age class with the
+#   same outcome are exchangeable and runs the same recursion over per-class
+#   infection counts, which costs about prod(q_c + 1)^2 over the classes c
+#
+# Parameter layout (nages age classes besides the reference class):
+# x = [llaL, llaG, logtheta, eta, alpha (nages), beta (nages), gamma (nages)]
+#
+# The kernels take all their inputs as arguments and are cached on disk (see
+# compile_kernels.py), so a fit loads them instead of compiling them again.
+
+import hashlib
+import heapq
+import json
+import math
+import pathlib
+import numpy as np
+from numpy import linalg as LA
+import numba
+from numba.core import caching
+
+
+# # Kernel cache
+#
+# Numba keys its cache on the modification time of the source file, but every
+# action runs on a fresh checkout of the repository. Key it on the contents of
+# the file instead, together with the contents of this module since the
+# kernels here are compiled into the callers' kernels. The cache goes to
+# output/numba_cache unless NUMBA_CACHE_DIR says otherwise.
+
+homedir = pathlib.Path(__file__).resolve().parent.parent
+kernel_cache_dir = homedir / "output" / "numba_cache"
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# The locator classes lost their leading underscore in later numba releases
+_UserProvidedCacheLocator = getattr(
+    caching, "UserProvidedCacheLocator", None
+) or getattr(caching, "_UserProvidedCacheLocator")
+
+
+class _ContentKeyedCacheLocator(_UserProvidedCacheLocator):
+    def get_source_stamp(self):
+        return _file_digest(self._py_file), _file_digest(__file__)
+
+
+if not numba.config.CACHE_DIR:
+    numba.config.CACHE_DIR = str(kernel_cache_dir)
+if _ContentKeyedCacheLocator not in caching.CacheImpl._locator_classes:
+    caching.CacheImpl._locator_classes.insert(0, _ContentKeyedCacheLocator)
+
+
+def kernel_cache_hits(*kernels):
+    # Number of the compiled signatures of kernels that came from the cache,
+    # and the number that had to be compiled
+    hits = sum(sum(k.stats.cache_hits.values()) for k in kernels)
+    misses = sum(sum(k.stats.cache_misses.values()) for k in kernels)
+    return hits, misses
+
+
+@numba.jit(nopython=True, cache=True)
+def phi(s, logtheta=0.0):
+    theta = np.exp(logtheta)
+    return (1.0 + theta * s) ** (-1.0 / theta)
+
+
+@numba.jit(nopython=True, cache=True)
+def log_phi(s, logtheta=0.0):
+    theta = np.exp(logtheta)
+    return -np.log1p(theta * s) / theta
+
+
+@numba.jit(nopython=True, cache=True)
+def decimal_to_bit_array(d, n_digits):
+    powers_of_two = int(2) ** np.arange(32)[::-1]
+    return ((d & powers_of_two) / powers_of_two)[-n_digits:]
+
+
+@numba.jit(nopython=True, cache=True)
+def build_submask_lattice(qmax):
+    # bits[jd, k] is bit k of jd, and the submasks of jd in increasing order
+    # are sub_idx[sub_ptr[jd] : sub_ptr[jd + 1]], ending with jd itself
+    r = 2 ** qmax
+    bits = np.zeros((r, max(qmax, 1)), dtype=np.uint8)
+    sub_ptr = np.zeros(r + 1, dtype=np.int64)
+    for jd in range(0, r):
+        n_sub = 1
+        for k in range(0, qmax):
+            bits[jd, k] = (jd >> k) & 1
+            n_sub *= 1 + bits[jd, k]
+        sub_ptr[jd + 1] = sub_ptr[jd] + n_sub
+    sub_idx = np.zeros(sub_ptr[r], dtype=np.int32)
+    for jd in range(0, r):
+        # Walks the submasks of jd downwards from jd to 0
+        s = sub_ptr[jd + 1] - 1
+        omd = jd
+        while True:
+            sub_idx[s] = omd
+            if omd == 0:
+                break
+            omd = (omd - 1) & jd
+            s -= 1
+    return bits, sub_ptr, sub_idx
+
+
+_submask_lattices = {}
+
+
+def submask_lattice(qmax):
+    # The tables for q cases are a prefix of those for qmax, so they are built
+    # once per process for the household with the most cases and then shared
+    # by every household and every evaluation. Storage grows as 3^qmax.
+    if qmax not in _submask_lattices:
+        _submask_lattices[qmax] = build_submask_lattice(qmax)
+    return _submask_lattices[qmax]
+
+
+# # Household store
+#
+# Households are kept as one flat uint8 array of case flags and one of age
+# codes, member by member, with household i in [offsets[i], offsets[i + 1])
+# and its cases after its negatives. Alongside those are the matching rows of
+# the design matrix, also uint8, and each household's members and cases, so
+# the kernels never sort or re-encode a household. The kernels take the arrays together
+# as households = (cases, ages, offsets, design, sizes, case_counts);
+# generate_model_data.py writes them as .npy files.
+
+
+def load_households(directory="output"):
+    # Returns the household store, the number of households sharing each
+    # pattern and the members of households without cases by age code.
+    # The store is memory-mapped read-only and goes to the kernels as it is,
+    # so nothing is deserialised or copied and fits running side by side
+    # share the operating system's single cached copy of the files.
+    directory = pathlib.Path(directory)
+    households, counts = load_store(directory)
+    negative_totals = np.load(directory / "negative_age_totals.npy").astype(np.float64)
+    return households, counts, negative_totals
+
+
+def load_store(directory):
+    # The household store in directory and the count of each pattern
+    households = tuple(
+        np.load(directory / f"household_{name}.npy", mmap_mode="r")
+        for name in ["cases", "ages", "offsets", "design", "sizes", "case_counts"]
+    )
+    counts = np.load(directory / "household_counts.npy").astype(np.float64)
+    return households, counts
+
+
+def group_by_household(hh_ids):
+    # Row order and offsets that lay a table with one row per person out in
+    # the same way as the store: one stable sort brings each household's rows
+    # together, households in order of first appearance and members in their
+    # order in the table, and household i is order[offsets[i] : offsets[i + 1]]
+    _, first, inverse = np.unique(
+        np.asarray(hh_ids), return_index=True, return_inverse=True
+    )
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    hh = rank[inverse.ravel()]
+    order = np.argsort(hh, kind="stable")
+    offsets = np.zeros(len(first) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(hh, minlength=len(first)), out=offsets[1:])
+    return order, offsets
+
+
+@numba.jit(nopython=True, cache=True)
+def household(households, i):
+    # Case flags and age codes of the members of household i
+    cases, ages, offsets, design, sizes, case_counts = households
+    return cases[offsets[i] : offsets[i + 1]], ages[offsets[i] : offsets[i + 1]]
+
+
+@numba.jit(nopython=True, cache=True)
+def household_design(households, i):
+    # Number of cases of household i and its design matrix, cases last. The
+    # store keeps one byte per entry; the kernels get a floating point copy.
+    cases, ages, offsets, design, sizes, case_counts = households
+    return case_counts[i], design[offsets[i] : offsets[i + 1], :].astype(np.float64)
+
+
+# # Loss of precision
+#
+# Both engines solve their triangular systems with sums whose terms alternate
+# in sign. With many cases in a household, and at some parameters with only
+# a few, the terms grow far larger than the result and cancel, and double
+# precision leaves too few correct digits in it, or none. The recursions
+# therefore carry alongside each Q a bound E on its rounding error: each
+# step adds the error of forming and summing its terms, about rounding_unit
+# times their absolute sum A, to the errors already in the Q it sums,
+# weighted as they are. E assumes those errors never cancel, and can
+# overstate the real error by many orders of magnitude, so when it is too
+# large to accept the final Q a second, backward pass (the _rounding_error
+# functions) weighs the error made at each step by the influence that step
+# actually has on the final Q, the solution of the transposed system. That
+# estimate is still typically ten to a hundred times the real error. A
+# household whose -log(Q) it cannot put within nll_tolerance is solved again
+# in extended precision (see "Extended precision" below) rather than given
+# up on. check_precision.py compares the kernels against a high precision
+# reference, both for wrong finite values and for accurate ones rejected.
+
+rounding_unit = np.finfo(np.float64).eps
+nll_tolerance = 1e-6
+
+
+@numba.jit(nopython=True, cache=True)
+def rounding_error(acc_abs, acc_err):
+    # Error bound for Q = 1 - acc, where acc_abs is the sum of the absolute
+    # values of the terms of acc and acc_err the sum of their inherited errors
+    return acc_err + rounding_unit * (1.0 + acc_abs)
+
+
+@numba.jit(nopython=True, cache=True)
+def precise_enough(Q, E):
+    # Whether -log(Q) is known to within nll_tolerance, given the error
+    # bound or estimate E on Q
+    return Q > 0.0 and E <= nll_tolerance * Q
+
+
+@numba.jit(nopython=True, cache=True)
+def ball_rounding_error(q, lattice, D, logB, lphi, A):
+    # Estimated rounding error in the last Q of the Ball recursion, given per
+    # row j its D_j, log B_j, log phi_k(j) of each case k in j and sum A_j of
+    # absolute terms. y_j, the influence of Q_j on the last Q, is complete
+    # once every row above j has been visited.
+    r = 2 ** q
+    bits, sub_ptr, sub_idx = lattice
+    L = np.zeros(r)
+    y = np.zeros(r)
+    y[r - 1] = 1.0
+    err = 0.0
+    for jd in range(r - 1, -1, -1):
+        err += abs(y[jd]) * rounding_unit * (1.0 + A[jd])
+        for s in range(sub_ptr[jd] + 1, sub_ptr[jd + 1] - 1):
+            omd = sub_idx[s]
+            k = 0
+            while (omd >> k) & 1 == 0:
+                k += 1
+            L[omd] = L[omd & (omd - 1)] + lphi[jd, k]
+        for s in range(sub_ptr[jd], sub_ptr[jd + 1] - 1):
+            omd = sub_idx[s]
+            y[omd] -= y[jd] * np.exp(D[omd] - L[omd] - logB[jd])
+    return err
+
+
+@numba.jit(nopython=True, cache=True)
+def ball_household_nll(y, X, lattice, llaL, llaG, logtheta, eta, alpha, beta, gamma):
+    # Negative log likelihood of one household with outcomes y and design
+    # matrix X (one row per member, one column per non-reference age class);
+    # lattice comes from submask_lattice and must cover the household's cases
+    if np.all(y == 0):
+        return np.exp(llaG) * np.sum(np.exp(alpha @ (X.T)))
+
+    # Sort to go zeros then ones WLOG (could do in pre-processing)
+    ii = np.argsort(y)
+    q = np.sum(y > 0)
+    return ball_sorted_household_nll(
+        q, X[ii, :], lattice, llaL, llaG, logtheta, eta, alpha, beta, gamma
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def ball_sorted_household_nll(
+    q, X, lattice, llaL, llaG, logtheta, eta, alpha, beta, gamma
+):
+    # As ball_household_nll, for a household whose q cases are the last q
+    # rows of X
+    m = X.shape[0]
+    r = 2 ** q
+
+    # Quantities that don't vary through the sum; log_Bk is the log
+    # probability of each member escaping community infection
+    log_Bk = -np.exp(llaG + X @ alpha)
+    laM = (
+        np.exp(llaL)
+        * np.outer(np.exp(beta @ (X.T)), np.exp(gamma @ (X.T)))
+        * (m ** eta)
+    )
+
+    # Subsets j of the cases are bitmasks, with bit k standing for member
+    # m - q + k. Only the 3^q pairs with omega a subset of j are visited.
+    bits, sub_ptr, sub_idx = lattice
+    not_j = np.ones(m)
+
+    # The Ball matrix BB is lower triangular and only the last component of
+    # the solution of BB P = 1 is needed, so build it a row at a time and
+    # forward-substitute as we go rather than storing the r x r matrix.
+    # Writing L_j(om) for the sum of log phi over the members of om on row j
+    # and D_j = L_j(j) + log B_j for the log of the diagonal term, the
+    # solution is carried as Q_j = P_j exp(-D_j), for which
+    #
+    #   Q_j = 1 - sum_{om < j} Q_om exp(D_om - L_j(om) - log B_j)
+    #
+    # Every exponent here is at most zero, so nothing can overflow, and the
+    # scaling keeps Q from underflowing however unlikely the household is.
+    # The sum alternates in sign, though, and with many cases its terms can
+    # be far larger than Q_j itself, so E_j carries a bound on the rounding
+    # error in Q_j, and logB, lphi and A what ball_rounding_error needs to
+    # estimate it more closely (see precise_enough).
+    Q = np.zeros(r)
+    E = np.zeros(r)
+    D = np.zeros(r)
+    L = np.zeros(r)
+    logB = np.zeros(r)
+    lphi = np.zeros((r, q))
+    A = np.zeros(r)
+    for jd in range(0, r):
+        for k in range(0, q):
+            not_j[m - q + k] = 1.0 - bits[jd, k]
+        log_phi_j = log_phi(not_j @ laM, logtheta)
+        log_Bj = not_j @ log_Bk
+        lphi[jd, :] = log_phi_j[m - q :]
+        logB[jd] = log_Bj
+
+        # Submasks come in increasing order, so om minus its lowest bit has
+        # always been visited before om; the last submask is j itself
+        for s in range(sub_ptr[jd] + 1, sub_ptr[jd + 1]):
+            omd = sub_idx[s]
+            k = 0
+            while (omd >> k) & 1 == 0:
+                k += 1
+            L[omd] = L[omd & (omd - 1)] + log_phi_j[m - q + k]
+        acc = 0.0
+        acc_abs = 0.0
+        acc_err = 0.0
+        for s in range(sub_ptr[jd], sub_ptr[jd + 1] - 1):
+            omd = sub_idx[s]
+            R = np.exp(D[omd] - L[omd] - log_Bj)
+            acc += Q[omd] * R
+            acc_abs += abs(Q[omd]) * R
+            acc_err += E[omd] * R
+        Q[jd] = 1.0 - acc
+        E[jd] = rounding_error(acc_abs, acc_err)
+        A[jd] = acc_abs
+        D[jd] = L[jd] + log_Bj
+
+    if Q[r - 1] > 0.0 and not precise_enough(Q[r - 1], E[r - 1]):
+        E[r - 1] = ball_rounding_error(q, lattice, D, logB, lphi, A)
+    if precise_enough(Q[r - 1], E[r - 1]):
+        return -D[r - 1] - np.log(Q[r - 1])
+    n, qc = design_class_counts(q, X)
+    return extended_counts_nll(
+        n, qc, llaL, llaG, logtheta, eta, alpha, beta, gamma, X.shape[1]
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def total_nll(x, W, nlv, add_ridge):
+    # Kept out of the parallel kernels so the reduction always runs serially
+    # in pattern order, which keeps fits bit-reproducible whatever the number
+    # of threads
+    nll = np.sum(W * nlv)  # Each pattern counts once per household
+    nll += add_ridge * np.sum(x ** 2)
+    return nll
+
+
+@numba.jit(nopython=True, cache=True)
+def negatives_nll(llaG, alpha, negative_totals, nages):
+    # All households without cases in one go: each contributes the community
+    # hazard of its members, so only the number of such members with each age
+    # code (negative_totals[code]) is needed
+    nll = 0.0
+    for code in range(0, len(negative_totals)):
+        xc = decimal_to_bit_array(code, nages)
+        nll += negative_totals[code] * np.exp(llaG + alpha @ xc)
+    return nll
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def ball_nll(x, households, W, negative_totals, nages, add_ridge, schedule, lattice):
+    order, bounds = schedule
+    llaL = x[0]
+    llaG = x[1]
+    logtheta = x[2]
+    eta = (4.0 / np.pi) * np.arctan(x[3])
+    alpha = x[4 : (4 + nages)]
+    beta = x[(4 + nages) : (4 + 2 * nages)]
+    gamma = x[(4 + 2 * nages) :]
+
+    nlv = np.zeros(len(W))  # Vector of negative log likelihoods per pattern
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            q, X = household_design(households, i)
+            nlv[i] = ball_sorted_household_nll(
+                q, X, lattice, llaL, llaG, logtheta, eta, alpha, beta, gamma
+            )
+    nll = total_nll(x, W, nlv, add_ridge)
+    return nll + negatives_nll(llaG, alpha, negative_totals, nages)
+
+
+@numba.jit(nopython=True, cache=True)
+def binomial_table(n):
+    # Pascal's triangle, C[a, w] = a choose w for 0 <= w <= a <= n
+    C = np.zeros((n + 1, n + 1))
+    for a in range(0, n + 1):
+        C[a, 0] = 1.0
+        for w in range(1, a + 1):
+            C[a, w] = C[a - 1, w - 1] + C[a - 1, w]
+    return C
+
+
+@numba.jit(nopython=True, cache=True)
+def exchangeable_household_nll(
+    y, ages, llaL, llaG, logtheta, eta, alpha, beta, gamma, nages
+):
+    # Members are grouped into the 2^nages classes given by their age bitmask.
+    # The Ball system is then solved over vectors a of per-class infection
+    # counts (0 <= a_c <= q_c), which is valid because the probability of a
+    # given set of infected members only depends on how many of them fall in
+    # each class. For each a, with S(a) the susceptibility of the members
+    # escaping infection,
+    #
+    #   P(a) = phi(a)^a B(a) - sum_{w < a} prod_c C(a_c, w_c) P(w) phi(a)^(a - w)
+    #
+    # where phi(a)^w = prod_c phi(lambda t_c S(a))^(w_c) and B(a) is the
+    # probability that the escaping members avoid community infection. As in
+    # ball_household_nll the recursion is run on Q(a) = P(a) exp(-D(a)), with
+    # D(a) the log of the diagonal term phi(a)^a B(a), so that no factor can
+    # overflow or underflow.
+    n, q = class_counts(y, ages, nages)
+    return exchangeable_counts_nll(
+        n, q, llaL, llaG, logtheta, eta, alpha, beta, gamma, nages
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def class_counts(y, ages, nages):
+    n = np.zeros(2 ** nages, dtype=np.int64)  # Members per class
+    q = np.zeros(2 ** nages, dtype=np.int64)  # Cases per class
+    for k in range(0, len(y)):
+        n[ages[k]] += 1
+        if y[k] > 0:
+            q[ages[k]] += 1
+    return n, q
+
+
+@numba.jit(nopython=True, cache=True)
+def exchangeable_rounding_error(q, strides, C, D, logB, lphi, A):
+    # As ball_rounding_error, for the recursion of exchangeable_counts_nll
+    # over the count vectors a, given per a its D(a), log B(a), log phi of
+    # each class and sum A(a) of absolute terms
+    ncls = len(q)
+    size = len(D)
+    a = np.zeros(ncls, dtype=np.int64)
+    w = np.zeros(ncls, dtype=np.int64)
+    y = np.zeros(size)
+    y[size - 1] = 1.0
+    err = 0.0
+    for ai in range(size - 1, -1, -1):
+        err += abs(y[ai]) * rounding_unit * (1.0 + A[ai])
+        rem = ai
+        for c in range(ncls - 1, -1, -1):
+            a[c] = rem // strides[c]
+            rem -= a[c] * strides[c]
+        w[:] = 0
+        while True:
+            idx = 0
+            coef = 1.0
+            Lw = 0.0
+            for c in range(0, ncls):
+                idx += w[c] * strides[c]
+                coef *= C[a[c], w[c]]
+                Lw += w[c] * lphi[ai, c]
+            if idx == ai:
+                break
+            y[idx] -= y[ai] * coef * np.exp(D[idx] - Lw - logB[ai])
+            c = 0
+            while w[c] == a[c]:
+                w[c] = 0
+                c += 1
+            w[c] += 1
+    return err
+
+
+@numba.jit(nopython=True, cache=True)
+def exchangeable_counts_nll(
+    n, q, llaL, llaG, logtheta, eta, alpha, beta, gamma, nages
+):
+    # As exchangeable_household_nll, for a household with n[c] members and
+    # q[c] cases in class c. Households for which double precision is not
+    # precise enough are solved again by extended_counts_nll.
+    ncls = 2 ** nages
+    m = np.sum(n)
+
+    # Per-class external hazard, susceptibility and transmissibility
+    log_escape = np.zeros(ncls)
+    susceptibility = np.zeros(ncls)
+    transmissibility = np.zeros(ncls)
+    for c in range(0, ncls):
+        xc = decimal_to_bit_array(c, nages)
+        log_escape[c] = -np.exp(llaG + alpha @ xc)
+        susceptibility[c] = np.exp(beta @ xc)
+        transmissibility[c] = np.exp(gamma @ xc)
+    lam = np.exp(llaL) * (m ** eta)
+
+    # Mixed-radix indexing of the count lattice; if w <= a elementwise then
+    # w comes no later than a, so a single forward sweep solves the system
+    strides = np.ones(ncls, dtype=np.int64)
+    for c in range(1, ncls):
+        strides[c] = strides[c - 1] * (q[c - 1] + 1)
+    size = strides[ncls - 1] * (q[ncls - 1] + 1)
+
+    C = binomial_table(np.max(q))
+    Q = np.zeros(size)
+    E = np.zeros(size)  # Error bounds, see precise_enough
+    A = np.zeros(size)
+    D = np.zeros(size)
+    row_logB = np.zeros(size)
+    row_lphi = np.zeros((size, ncls))
+    a = np.zeros(ncls, dtype=np.int64)
+    w = np.zeros(ncls, dtype=np.int64)
+    lphi = np.zeros(ncls)
+    for ai in range(0, size):
+        rem = ai
+        for c in range(ncls - 1, -1, -1):
+            a[c] = rem // strides[c]
+            rem -= a[c] * strides[c]
+
+        S = 0.0
+        logB = 0.0
+        for c in range(0, ncls):
+            S += (n[c] - a[c]) * susceptibility[c]
+            logB += (n[c] - a[c]) * log_escape[c]
+        La = 0.0
+        for c in range(0, ncls):
+            if q[c] > 0:
+                lphi[c] = log_phi(lam * transmissibility[c] * S, logtheta)
+                La += a[c] * lphi[c]
+            else:
+                lphi[c] = 0.0
+        row_logB[ai] = logB
+        row_lphi[ai, :] = lphi
+
+        # Sum over the strict sub-vectors w < a with an odometer
+        acc = 0.0
+        acc_abs = 0.0
+        acc_err = 0.0
+        w[:] = 0
+        while True:
+            idx = 0
+            coef = 1.0
+            Lw = 0.0
+            for c in range(0, ncls):
+                idx += w[c] * strides[c]
+                coef *= C[a[c], w[c]]
+                Lw += w[c] * lphi[c]
+            if idx == ai:
+                break
+            R = coef * np.exp(D[idx] - Lw - logB)
+            acc += Q[idx] * R
+            acc_abs += abs(Q[idx]) * R
+            acc_err += E[idx] * R
+            c = 0
+            while w[c] == a[c]:
+                w[c] = 0
+                c += 1
+            w[c] += 1
+        Q[ai] = 1.0 - acc
+        E[ai] = rounding_error(acc_abs, acc_err)
+        A[ai] = acc_abs
+        D[ai] = La + logB
+
+    if Q[size - 1] > 0.0 and not precise_enough(Q[size - 1], E[size - 1]):
+        E[size - 1] = exchangeable_rounding_error(
+            q, strides, C, D, row_logB, row_lphi, A
+        )
+    if precise_enough(Q[size - 1], E[size - 1]):
+        return -D[size - 1] - np.log(Q[size - 1])
+    return extended_counts_nll(
+        n, q, llaL, llaG, logtheta, eta, alpha, beta, gamma, nages
+    )
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def exchangeable_nll(x, households, W, negative_totals, nages, add_ridge, schedule):
+    order, bounds = schedule
+    llaL = x[0]
+    llaG = x[1]
+    logtheta = x[2]
+    eta = (4.0 / np.pi) * np.arctan(x[3])
+    alpha = x[4 : (4 + nages)]
+    beta = x[(4 + nages) : (4 + 2 * nages)]
+    gamma = x[(4 + 2 * nages) :]
+
+    nlv = np.zeros(len(W))  # Vector of negative log likelihoods per pattern
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            y, ages = household(households, i)
+            nlv[i] = exchangeable_household_nll(
+                y, ages, llaL, llaG, logtheta, eta, alpha, beta, gamma, nages
+            )
+    nll = total_nll(x, W, nlv, add_ridge)
+    return nll + negatives_nll(llaG, alpha, negative_totals, nages)
+
+
+# # Batched evaluation
+#
+# The _batch kernels take a k x p matrix xs with one parameter vector per row
+# and return the k negative log likelihoods from a single pass over the
+# households, so the per-household set-up (class counts for the
+# exchangeable engine) is shared by all k points. Each point gets the same serial
+# reduction as the single-point kernels, so the results agree exactly.
+
+
+@numba.jit(nopython=True, cache=True)
+def batch_totals(xs, W, nlv, negative_totals, nages, add_ridge):
+    # nlv[p, i] is the negative log likelihood of pattern i at xs[p]
+    nll = np.zeros(xs.shape[0])
+    for p in range(0, xs.shape[0]):
+        alpha = xs[p, 4 : (4 + nages)]
+        nll[p] = total_nll(xs[p], W, nlv[p], add_ridge)
+        nll[p] += negatives_nll(xs[p, 1], alpha, negative_totals, nages)
+    return nll
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def ball_nll_batch(
+    xs, households, W, negative_totals, nages, add_ridge, schedule, lattice
+):
+    order, bounds = schedule
+    eta = (4.0 / np.pi) * np.arctan(xs[:, 3])
+
+    nlv = np.zeros((xs.shape[0], len(W)))
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            q, X = household_design(households, i)
+            for p in range(0, xs.shape[0]):
+                x = xs[p]
+                nlv[p, i] = ball_sorted_household_nll(
+                    q,
+                    X,
+                    lattice,
+                    x[0],
+                    x[1],
+                    x[2],
+                    eta[p],
+                    x[4 : (4 + nages)],
+                    x[(4 + nages) : (4 + 2 * nages)],
+                    x[(4 + 2 * nages) :],
+                )
+    return batch_totals(xs, W, nlv, negative_totals, nages, add_ridge)
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def exchangeable_nll_batch(
+    xs, households, W, negative_totals, nages, add_ridge, schedule
+):
+    order, bounds = schedule
+    eta = (4.0 / np.pi) * np.arctan(xs[:, 3])
+
+    nlv = np.zeros((xs.shape[0], len(W)))
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            y, ages = household(households, i)
+            n, q = class_counts(y, ages, nages)
+            for p in range(0, xs.shape[0]):
+                x = xs[p]
+                nlv[p, i] = exchangeable_counts_nll(
+                    n,
+                    q,
+                    x[0],
+                    x[1],
+                    x[2],
+                    eta[p],
+                    x[4 : (4 + nages)],
+                    x[(4 + nages) : (4 + 2 * nages)],
+                    x[(4 + 2 * nages) :],
+                    nages,
+                )
+    return batch_totals(xs, W, nlv, negative_totals, nages, add_ridge)
+
+
+# # Extended precision
+#
+# Households whose double precision value the recursions cannot vouch for are
+# solved again in double-double arithmetic, each number carried as the
+# unevaluated sum hi + lo of two doubles, which gives about 32 significant
+# digits. The exchangeable recursion is used whichever engine flagged the
+# household, since it gives the same probability for fewer terms, and with it
+# every quantity that feeds the sums (the exponentials and logarithms as well
+# as the sums themselves), because the rounding of the terms in double
+# precision is as much to blame as the rounding of their sum. Gradients are
+# central differences of the double-double value, which is precise enough
+# for steps of 1e-6. Only a household that loses even these digits gets an
+# infinite negative log likelihood.
+
+# Unit of the error bounds in double-double arithmetic, allowing for the
+# exponentials and logarithms being less precise than the basic operations
+extended_rounding_unit = 16.0 * rounding_unit ** 2
+ln2_hi = 6.93147180559945286e-01
+ln2_lo = 2.31904681384629956e-17
+
+
+@numba.jit(nopython=True, cache=True)
+def two_sum(a, b):
+    s = a + b
+    v = s - a
+    return s, (a - (s - v)) + (b - v)
+
+
+@numba.jit(nopython=True, cache=True)
+def quick_two_sum(a, b):
+    # As two_sum, for |a| >= |b|
+    s = a + b
+    return s, b - (s - a)
+
+
+@numba.jit(nopython=True, cache=True)
+def two_prod(a, b):
+    # Dekker's product, splitting each factor into halves of 26 bits
+    p = a * b
+    t = 134217729.0 * a
+    ah = t - (t - a)
+    al = a - ah
+    t = 134217729.0 * b
+    bh = t - (t - b)
+    bl = b - bh
+    return p, ((ah * bh - p) + ah * bl + al * bh) + al * bl
+
+
+@numba.jit(nopython=True, cache=True)
+def dd_add(ah, al, bh, bl):
+    s, e = two_sum(ah, bh)
+    t, f = two_sum(al, bl)
+    s, e = quick_two_sum(s, e + t)
+    return quick_two_sum(s, e + f)
+
+
+@numba.jit(nopython=True, cache=True)
+def dd_mul(ah, al, bh, bl):
+    p, e = two_prod(ah, bh)
+    return quick_two_sum(p, e + (ah * bl + al * bh))
+
+
+@numba.jit(nopython=True, cache=True)
+def dd_div(ah, al, bh, bl):
+    q1 = ah / bh
+    ph, pl = dd_mul(q1, 0.0, bh, bl)
+    rh, rl = dd_add(ah, al, -ph, -pl)
+    q2 = rh / bh
+    ph, pl = dd_mul(q2, 0.0, bh, bl)
+    rh, rl = dd_add(rh, rl, -ph, -pl)
+    q3 = rh / bh
+    q1, q2 = quick_two_sum(q1, q2)
+    return dd_add(q1, q2, q3, 0.0)
+
+
+@numba.jit(nopython=True, cache=True)
+def dd_exp(ah, al):
+    # exp(a) = 2^k exp(r) with |r| <= log(2) / 2, and exp(r) from the Taylor
+    # series of expm1(r / 1024) squared up ten times
+    if ah < -745.0:
+        return 0.0, 0.0
+    k = np.floor(ah / ln2_hi + 0.5)
+    ph, pl = dd_mul(k, 0.0, ln2_hi, ln2_lo)
+    rh, rl = dd_add(ah, al, -ph, -pl)
+    rh /= 1024.0
+    rl /= 1024.0
+    sh, sl = rh, rl
+    th, tl = rh, rl
+    for i in range(2, 12):
+        th, tl = dd_mul(th, tl, rh, rl)
+        th, tl = dd_div(th, tl, float(i), 0.0)
+        sh, sl = dd_add(sh, sl, th, tl)
+    for i in range(0, 10):
+        th, tl = dd_mul(sh, sl, sh, sl)
+        sh, sl = dd_add(2.0 * sh, 2.0 * sl, th, tl)
+    sh, sl = dd_add(1.0, 0.0, sh, sl)
+    return math.ldexp(sh, int(k)), math.ldexp(sl, int(k))
+
+
+@numba.jit(nopython=True, cache=True)
+def dd_log(ah, al):
+    # One Newton step x + a exp(-x) - 1 from the double precision logarithm
+    x = np.log(ah)
+    eh, el = dd_exp(-x, 0.0)
+    th, tl = dd_mul(ah, al, eh, el)
+    th, tl = dd_add(th, tl, -1.0, 0.0)
+    return dd_add(x, 0.0, th, tl)
+
+
+@numba.jit(nopython=True, cache=True)
+def dd_dot_bits(c, v, nages):
+    # v @ decimal_to_bit_array(c, nages), summed without rounding
+    xc = decimal_to_bit_array(c, nages)
+    sh, sl = 0.0, 0.0
+    for b in range(0, nages):
+        if xc[b] > 0:
+            sh, sl = dd_add(sh, sl, v[b], 0.0)
+    return sh, sl
+
+
+@numba.jit(nopython=True, cache=True)
+def design_class_counts(q, X):
+    # Members and cases per age class of a household whose q cases are the
+    # last q rows of its design matrix X
+    m, nages = X.shape
+    n = np.zeros(2 ** nages, dtype=np.int64)
+    qc = np.zeros(2 ** nages, dtype=np.int64)
+    for l in range(0, m):
+        c = 0
+        for b in range(0, nages):
+            c = 2 * c + int(X[l, b])
+        n[c] += 1
+        if l >= m - q:
+            qc[c] += 1
+    return n, qc
+
+
+@numba.jit(nopython=True, cache=True)
+def extended_counts_nll(n, q, llaL, llaG, logtheta, eta, alpha, beta, gamma, nages):
+    # As exchangeable_counts_nll, in double-double arithmetic; arrays ending
+    # in h and l hold the high and low parts
+    ncls = 2 ** nages
+    m = np.sum(n)
+
+    log_escape_h = np.zeros(ncls)
+    log_escape_l = np.zeros(ncls)
+    susceptibility_h = np.zeros(ncls)
+    susceptibility_l = np.zeros(ncls)
+    transmissibility_h = np.zeros(ncls)
+    transmissibility_l = np.zeros(ncls)
+    for c in range(0, ncls):
+        th, tl = dd_dot_bits(c, alpha, nages)
+        th, tl = dd_exp(*dd_add(th, tl, llaG, 0.0))
+        log_escape_h[c], log_escape_l[c] = -th, -tl
+        susceptibility_h[c], susceptibility_l[c] = dd_exp(*dd_dot_bits(c, beta, nages))
+        transmissibility_h[c], transmissibility_l[c] = dd_exp(
+            *dd_dot_bits(c, gamma, nages)
+        )
+    th, tl = dd_mul(eta, 0.0, *dd_log(float(m), 0.0))
+    lam_h, lam_l = dd_exp(*dd_add(th, tl, llaL, 0.0))
+    theta_h, theta_l = dd_exp(logtheta, 0.0)
+
+    strides = np.ones(ncls, dtype=np.int64)
+    for c in range(1, ncls):
+        strides[c] = strides[c - 1] * (q[c - 1] + 1)
+    size = strides[ncls - 1] * (q[ncls - 1] + 1)
+
+    C = binomial_table(np.max(q))
+    Qh = np.zeros(size)
+    Ql = np.zeros(size)
+    E = np.zeros(size)  # Error bounds, see precise_enough
+    A = np.zeros(size)
+    Dh = np.zeros(size)
+    Dl = np.zeros(size)
+    row_logB = np.zeros(size)
+    row_lphi = np.zeros((size, ncls))
+    a = np.zeros(ncls, dtype=np.int64)
+    w = np.zeros(ncls, dtype=np.int64)
+    lphi_h = np.zeros(ncls)
+    lphi_l = np.zeros(ncls)
+    for ai in range(0, size):
+        rem = ai
+        for c in range(ncls - 1, -1, -1):
+            a[c] = rem // strides[c]
+            rem -= a[c] * strides[c]
+
+        Sh, Sl = 0.0, 0.0
+        logBh, logBl = 0.0, 0.0
+        for c in range(0, ncls):
+            k = float(n[c] - a[c])
+            Sh, Sl = dd_add(
+                Sh, Sl, *dd_mul(k, 0.0, susceptibility_h[c], susceptibility_l[c])
+            )
+            logBh, logBl = dd_add(
+                logBh, logBl, *dd_mul(k, 0.0, log_escape_h[c], log_escape_l[c])
+            )
+        Lah, Lal = 0.0, 0.0
+        for c in range(0, ncls):
+            lphi_h[c], lphi_l[c] = 0.0, 0.0
+            if q[c] > 0:
+                # log phi(s) = -log(1 + theta s) / theta
+                th, tl = dd_mul(
+                    lam_h, lam_l, transmissibility_h[c], transmissibility_l[c]
+                )
+                th, tl = dd_mul(th, tl, Sh, Sl)
+                th, tl = dd_mul(th, tl, theta_h, theta_l)
+                th, tl = dd_log(*dd_add(1.0, 0.0, th, tl))
+                th, tl = dd_div(th, tl, theta_h, theta_l)
+                lphi_h[c], lphi_l[c] = -th, -tl
+                Lah, Lal = dd_add(Lah, Lal, *dd_mul(float(a[c]), 0.0, -th, -tl))
+        row_logB[ai] = logBh
+        row_lphi[ai, :] = lphi_h
+
+        acc_h, acc_l = 0.0, 0.0
+        acc_abs = 0.0
+        acc_err = 0.0
+        w[:] = 0
+        while True:
+            idx = 0
+            coef = 1.0
+            Lwh, Lwl = 0.0, 0.0
+            for c in range(0, ncls):
+                idx += w[c] * strides[c]
+                coef *= C[a[c], w[c]]
+                if w[c] > 0:
+                    Lwh, Lwl = dd_add(
+                        Lwh, Lwl, *dd_mul(float(w[c]), 0.0, lphi_h[c], lphi_l[c])
+                    )
+            if idx == ai:
+                break
+            th, tl = dd_add(Dh[idx], Dl[idx], -Lwh, -Lwl)
+            th, tl = dd_exp(*dd_add(th, tl, -logBh, -logBl))
+            Rh, Rl = dd_mul(coef, 0.0, th, tl)
+            acc_h, acc_l = dd_add(acc_h, acc_l, *dd_mul(Qh[idx], Ql[idx], Rh, Rl))
+            acc_abs += abs(Qh[idx]) * Rh
+            acc_err += E[idx] * Rh
+            c = 0
+            while w[c] == a[c]:
+                w[c] = 0
+                c += 1
+            w[c] += 1
+        Qh[ai], Ql[ai] = dd_add(1.0, 0.0, -acc_h, -acc_l)
+        E[ai] = acc_err + extended_rounding_unit * (1.0 + acc_abs)
+        A[ai] = acc_abs
+        Dh[ai], Dl[ai] = dd_add(Lah, Lal, logBh, logBl)
+
+    Q = Qh[size - 1]
+    if Q > 0.0 and not precise_enough(Q, E[size - 1]):
+        # The backward pass only needs the magnitudes of the terms, so the
+        # high parts do, scaled from the double to the double-double unit
+        E[size - 1] = exchangeable_rounding_error(
+            q, strides, C, Dh, row_logB, row_lphi, A
+        ) * (extended_rounding_unit / rounding_unit)
+    if precise_enough(Q, E[size - 1]):
+        th, tl = dd_log(Qh[size - 1], Ql[size - 1])
+        return dd_add(-Dh[size - 1], -Dl[size - 1], -th, -tl)[0]
+    return np.inf
+
+
+@numba.jit(nopython=True, cache=True)
+def extended_counts_nll_grad(
+    n, q, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma, nages
+):
+    # extended_counts_nll and its gradient with respect to x, by central
+    # differences in each parameter
+    npar = 4 + 3 * nages
+    p = np.zeros(npar)
+    p[0] = llaL
+    p[1] = llaG
+    p[2] = logtheta
+    p[3] = eta
+    p[4 : (4 + nages)] = alpha
+    p[(4 + nages) : (4 + 2 * nages)] = beta
+    p[(4 + 2 * nages) :] = gamma
+    nll = extended_counts_nll(n, q, p[0], p[1], p[2], p[3], alpha, beta, gamma, nages)
+    grad = np.zeros(npar)
+    if not np.isfinite(nll):
+        return np.inf, grad
+    for k in range(0, npar):
+        h = 1e-6 * max(1.0, abs(p[k]))
+        f = np.zeros(2)
+        for side in range(0, 2):
+            ps = p.copy()
+            ps[k] += h if side == 0 else -h
+            f[side] = extended_counts_nll(
+                n,
+                q,
+                ps[0],
+                ps[1],
+                ps[2],
+                ps[3],
+                ps[4 : (4 + nages)],
+                ps[(4 + nages) : (4 + 2 * nages)],
+                ps[(4 + 2 * nages) :],
+                nages,
+            )
+        if not np.all(np.isfinite(f)):
+            return np.inf, np.zeros(npar)
+        grad[k] = (f[0] - f[1]) / (2.0 * h)
+    grad[3] *= deta
+    return nll, grad
+
+
+# # Gradients
+#
+# The _grad kernels return the same negative log likelihoods together with
+# their gradients with respect to x, for optimisers that take a jacobian.
+# Derivatives are carried forward through the scaled triangular solve of
+# ball_household_nll alongside the solution,
+#
+#   Q_j = 1 - sum_{om < j} Q_om R_{j,om}
+#   R_{j,om} = exp(D_om - L_j(om) - log B_j),  D_j = L_j(j) + log B_j
+#
+# where L_j(om) is the sum of log phi_k(j) over the members k of om and B_j
+# is the probability that the members outside j escape community infection.
+# The exchangeable engine is the same recursion over count vectors, with the
+# binomial multiplicities as constant factors.
+
+
+@numba.jit(nopython=True, cache=True)
+def log_phi_grad(s, logtheta=0.0):
+    # Derivatives of log_phi with respect to s and to logtheta
+    theta = np.exp(logtheta)
+    d_s = -1.0 / (1.0 + theta * s)
+    d_logtheta = np.log1p(theta * s) / theta + s * d_s
+    return d_s, d_logtheta
+
+
+@numba.jit(nopython=True, cache=True)
+def ball_sorted_household_nll_grad(
+    q, X, lattice, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma
+):
+    # As ball_sorted_household_nll, where deta is the derivative of eta with
+    # respect to x[3]. Returns the negative log likelihood and its gradient.
+    m, nages = X.shape
+    npar = 4 + 3 * nages
+    hazard = np.exp(llaG + X @ alpha)  # Community hazard of each member
+    r = 2 ** q
+
+    susceptibility = np.exp(X @ beta)
+    transmissibility = np.exp(X @ gamma)
+    lam = np.exp(llaL) * (m ** eta)
+    log_m = np.log(m)
+
+    # Subsets j of the cases are bitmasks, with bit k standing for member
+    # m - q + k; see ball_household_nll
+    bits, sub_ptr, sub_idx = lattice
+    Q = np.zeros(r)
+    E = np.zeros(r)  # Error bounds, see precise_enough
+    A = np.zeros(r)
+    row_logB = np.zeros(r)
+    row_lphi = np.zeros((r, q))
+    dQ = np.zeros((r, npar))
+    D = np.zeros(r)
+    dD = np.zeros((r, npar))
+    L = np.zeros(r)  # L_om(j) for the submasks of the current row
+    dL = np.zeros((r, npar))
+    lphi = np.zeros(q)
+    dlphi = np.zeros((q, npar))
+    Sx = np.zeros(nages)
+    hx = np.zeros(nages)
+    dlogB = np.zeros(npar)
+    dacc = np.zeros(npar)
+    for jd in range(0, r):
+        # Members escaping infection are the negatives and the cases outside j
+        S = 0.0
+        Sx[:] = 0.0
+        logB = 0.0
+        hx[:] = 0.0
+        for l in range(0, m):
+            if l < m - q or bits[jd, l - (m - q)] == 0:
+                S += susceptibility[l]
+                Sx += susceptibility[l] * X[l, :]
+                logB -= hazard[l]
+                hx += hazard[l] * X[l, :]
+        dlogB[1] = logB
+        dlogB[4 : (4 + nages)] = -hx
+
+        for k in range(0, q):
+            if bits[jd, k]:
+                kk = m - q + k
+                s_k = lam * transmissibility[kk] * S
+                lphi[k] = log_phi(s_k, logtheta)
+                d_s, d_logtheta = log_phi_grad(s_k, logtheta)
+                dlphi[k, 0] = d_s * s_k
+                dlphi[k, 2] = d_logtheta
+                dlphi[k, 3] = d_s * s_k * log_m * deta
+                dlphi[k, (4 + nages) : (4 + 2 * nages)] = (
+                    d_s * lam * transmissibility[kk] * Sx
+                )
+                dlphi[k, (4 + 2 * nages) :] = d_s * s_k * X[kk, :]
+        row_logB[jd] = logB
+        row_lphi[jd, :] = lphi
+
+        # Submasks come in increasing order, so om minus its lowest bit has
+        # always been visited before om
+        for s in range(sub_ptr[jd], sub_ptr[jd + 1]):
+            omd = sub_idx[s]
+            if omd == 0:
+                L[0] = 0.0
+                dL[0, :] = 0.0
+            else:
+                k = 0
+                while (omd >> k) & 1 == 0:
+                    k += 1
+                prev = omd & (omd - 1)
+                L[omd] = L[prev] + lphi[k]
+                dL[omd, :] = dL[prev, :] + dlphi[k, :]
+        acc = 0.0
+        acc_abs = 0.0
+        acc_err = 0.0
+        dacc[:] = 0.0
+        for s in range(sub_ptr[jd], sub_ptr[jd + 1] - 1):
+            omd = sub_idx[s]
+            R = np.exp(D[omd] - L[omd] - logB)
+            acc += Q[omd] * R
+            acc_abs += abs(Q[omd]) * R
+            acc_err += E[omd] * R
+            dacc += R * (dQ[omd, :] + Q[omd] * (dD[omd, :] - dL[omd, :] - dlogB))
+        Q[jd] = 1.0 - acc
+        E[jd] = rounding_error(acc_abs, acc_err)
+        A[jd] = acc_abs
+        dQ[jd, :] = -dacc
+        D[jd] = L[jd] + logB
+        dD[jd, :] = dL[jd, :] + dlogB
+
+    if Q[r - 1] > 0.0 and not precise_enough(Q[r - 1], E[r - 1]):
+        E[r - 1] = ball_rounding_error(q, lattice, D, row_logB, row_lphi, A)
+    if precise_enough(Q[r - 1], E[r - 1]):
+        return -D[r - 1] - np.log(Q[r - 1]), -dD[r - 1, :] - dQ[r - 1, :] / Q[r - 1]
+    n, qc = design_class_counts(q, X)
+    return extended_counts_nll_grad(
+        n, qc, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma, nages
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def exchangeable_household_nll_grad(
+    y, ages, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma, nages
+):
+    # As exchangeable_household_nll, where deta is the derivative of eta with
+    # respect to x[3]. Returns the negative log likelihood and its gradient.
+    ncls = 2 ** nages
+    npar = 4 + 3 * nages
+    m = len(y)
+    n, q = class_counts(y, ages, nages)
+
+    xcls = np.zeros((ncls, nages))
+    log_escape = np.zeros(ncls)
+    susceptibility = np.zeros(ncls)
+    transmissibility = np.zeros(ncls)
+    for c in range(0, ncls):
+        xcls[c, :] = decimal_to_bit_array(c, nages)
+        log_escape[c] = -np.exp(llaG + alpha @ xcls[c, :])
+        susceptibility[c] = np.exp(beta @ xcls[c, :])
+        transmissibility[c] = np.exp(gamma @ xcls[c, :])
+    lam = np.exp(llaL) * (m ** eta)
+    log_m = np.log(m)
+
+    strides = np.ones(ncls, dtype=np.int64)
+    for c in range(1, ncls):
+        strides[c] = strides[c - 1] * (q[c - 1] + 1)
+    size = strides[ncls - 1] * (q[ncls - 1] + 1)
+
+    C = binomial_table(np.max(q))
+    Q = np.zeros(size)
+    E = np.zeros(size)  # Error bounds, see precise_enough
+    A = np.zeros(size)
+    row_logB = np.zeros(size)
+    row_lphi = np.zeros((size, ncls))
+    dQ = np.zeros((size, npar))
+    D = np.zeros(size)
+    dD = np.zeros((size, npar))
+    a = np.zeros(ncls, dtype=np.int64)
+    w = np.zeros(ncls, dtype=np.int64)
+    lphi = np.zeros(ncls)
+    dlphi = np.zeros((ncls, npar))
+    Sx = np.zeros(nages)
+    dlogB = np.zeros(npar)
+    dLa = np.zeros(npar)
+    dLw = np.zeros(npar)
+    dacc = np.zeros(npar)
+    for ai in range(0, size):
+        rem = ai
+        for c in range(ncls - 1, -1, -1):
+            a[c] = rem // strides[c]
+            rem -= a[c] * strides[c]
+
+        S = 0.0
+        Sx[:] = 0.0
+        logB = 0.0
+        dlogB[:] = 0.0
+        for c in range(0, ncls):
+            S += (n[c] - a[c]) * susceptibility[c]
+            Sx += (n[c] - a[c]) * susceptibility[c] * xcls[c, :]
+            logB += (n[c] - a[c]) * log_escape[c]
+            dlogB[4 : (4 + nages)] += (n[c] - a[c]) * log_escape[c] * xcls[c, :]
+        dlogB[1] = logB
+
+        La = 0.0
+        dLa[:] = 0.0
+        for c in range(0, ncls):
+            lphi[c] = 0.0
+            dlphi[c, :] = 0.0
+            if q[c] > 0:
+                s_c = lam * transmissibility[c] * S
+                lphi[c] = log_phi(s_c, logtheta)
+                d_s, d_logtheta = log_phi_grad(s_c, logtheta)
+                dlphi[c, 0] = d_s * s_c
+                dlphi[c, 2] = d_logtheta
+                dlphi[c, 3] = d_s * s_c * log_m * deta
+                dlphi[c, (4 + nages) : (4 + 2 * nages)] = (
+                    d_s * lam * transmissibility[c] * Sx
+                )
+                dlphi[c, (4 + 2 * nages) :] = d_s * s_c * xcls[c, :]
+                La += a[c] * lphi[c]
+                dLa += a[c] * dlphi[c, :]
+        row_logB[ai] = logB
+        row_lphi[ai, :] = lphi
+
+        acc = 0.0
+        acc_abs = 0.0
+        acc_err = 0.0
+        dacc[:] = 0.0
+        w[:] = 0
+        while True:
+            idx = 0
+            coef = 1.0
+            Lw = 0.0
+            dLw[:] = 0.0
+            for c in range(0, ncls):
+                idx += w[c] * strides[c]
+                coef *= C[a[c], w[c]]
+                Lw += w[c] * lphi[c]
+                dLw += w[c] * dlphi[c, :]
+            if idx == ai:
+                break
+            R = coef * np.exp(D[idx] - Lw - logB)
+            acc += Q[idx] * R
+            acc_abs += abs(Q[idx]) * R
+            acc_err += E[idx] * R
+            dacc += R * (dQ[idx, :] + Q[idx] * (dD[idx, :] - dLw - dlogB))
+            c = 0
+            while w[c] == a[c]:
+                w[c] = 0
+                c += 1
+            w[c] += 1
+        Q[ai] = 1.0 - acc
+        E[ai] = rounding_error(acc_abs, acc_err)
+        A[ai] = acc_abs
+        dQ[ai, :] = -dacc
+        D[ai] = La + logB
+        dD[ai, :] = dLa + dlogB
+
+    if Q[size - 1] > 0.0 and not precise_enough(Q[size - 1], E[size - 1]):
+        E[size - 1] = exchangeable_rounding_error(
+            q, strides, C, D, row_logB, row_lphi, A
+        )
+    if precise_enough(Q[size - 1], E[size - 1]):
+        return -D[size - 1] - np.log(Q[size - 1]), (
+            -dD[size - 1, :] - dQ[size - 1, :] / Q[size - 1]
+        )
+    return extended_counts_nll_grad(
+        n, q, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma, nages
+    )
+
+
+@numba.jit(nopython=True, cache=True)
+def total_nll_grad(x, W, nlv, grads, add_ridge):
+    # Serial reduction in pattern order, as in total_nll
+    nll = total_nll(x, W, nlv, add_ridge)
+    grad = 2.0 * add_ridge * x
+    for i in range(0, len(nlv)):
+        grad += W[i] * grads[i, :]
+    return nll, grad
+
+
+@numba.jit(nopython=True, cache=True)
+def negatives_nll_grad(llaG, alpha, negative_totals, nages):
+    # As negatives_nll, with the derivatives with respect to llaG and alpha
+    nll = 0.0
+    dalpha = np.zeros(nages)
+    for code in range(0, len(negative_totals)):
+        xc = decimal_to_bit_array(code, nages)
+        term = negative_totals[code] * np.exp(llaG + alpha @ xc)
+        nll += term
+        dalpha += term * xc
+    return nll, nll, dalpha
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def ball_nll_grad(
+    x, households, W, negative_totals, nages, add_ridge, schedule, lattice
+):
+    order, bounds = schedule
+    llaL = x[0]
+    llaG = x[1]
+    logtheta = x[2]
+    eta = (4.0 / np.pi) * np.arctan(x[3])
+    deta = (4.0 / np.pi) / (1.0 + x[3] ** 2)
+    alpha = x[4 : (4 + nages)]
+    beta = x[(4 + nages) : (4 + 2 * nages)]
+    gamma = x[(4 + 2 * nages) :]
+
+    nlv = np.zeros(len(W))
+    grads = np.zeros((len(W), len(x)))
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            q, X = household_design(households, i)
+            nlv[i], grads[i, :] = ball_sorted_household_nll_grad(
+                q, X, lattice, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma
+            )
+    nll, grad = total_nll_grad(x, W, nlv, grads, add_ridge)
+    nll0, dllaG, dalpha = negatives_nll_grad(llaG, alpha, negative_totals, nages)
+    grad[1] += dllaG
+    grad[4 : (4 + nages)] += dalpha
+    return nll + nll0, grad
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def exchangeable_nll_grad(
+    x, households, W, negative_totals, nages, add_ridge, schedule
+):
+    order, bounds = schedule
+    llaL = x[0]
+    llaG = x[1]
+    logtheta = x[2]
+    eta = (4.0 / np.pi) * np.arctan(x[3])
+    deta = (4.0 / np.pi) / (1.0 + x[3] ** 2)
+    alpha = x[4 : (4 + nages)]
+    beta = x[(4 + nages) : (4 + 2 * nages)]
+    gamma = x[(4 + 2 * nages) :]
+
+    nlv = np.zeros(len(W))
+    grads = np.zeros((len(W), len(x)))
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            y, ages = household(households, i)
+            nlv[i], grads[i, :] = exchangeable_household_nll_grad(
+                y, ages, llaL, llaG, logtheta, eta, deta, alpha, beta, gamma, nages
+            )
+    nll, grad = total_nll_grad(x, W, nlv, grads, add_ridge)
+    nll0, dllaG, dalpha = negatives_nll_grad(llaG, alpha, negative_totals, nages)
+    grad[1] += dllaG
+    grad[4 : (4 + nages)] += dalpha
+    return nll + nll0, grad
+
+
+# # Scheduling
+#
+# The kernels above walk the households in chunks, one chunk per parallel
+# iteration. Household cost grows exponentially with the number of cases, so
+# chunks are balanced on expected cost rather than on household count; every
+# household writes to its own slot and the sum is taken afterwards, so the
+# result does not depend on the schedule.
+
+
+def ball_costs(sizes, q):
+    # Entries visited in the Ball matrix by households with sizes members
+    # and q cases
+    return np.asarray(sizes) + 3.0 ** np.asarray(q)
+
+
+@numba.jit(nopython=True, cache=True)
+def exchangeable_costs(households, nages):
+    cases, ages, offsets, design, sizes, case_counts = households
+    ncls = 2 ** nages
+    costs = np.zeros(len(offsets) - 1)
+    q = np.zeros(ncls)
+    for i in range(0, len(costs)):
+        q[:] = 0.0
+        for k in range(offsets[i], offsets[i + 1]):
+            if cases[k] > 0:
+                q[ages[k]] += 1.0
+        # Pairs w <= a visited over the count lattice
+        m = offsets[i + 1] - offsets[i]
+        costs[i] = m + ncls * np.prod((q + 1.0) * (q + 2.0) / 2.0)
+    return costs
+
+
+def cost_balanced_chunks(costs, n_chunks):
+    # Longest processing time first: deal the households out in decreasing
+    # order of cost, each to the chunk with the least work so far. Chunk c
+    # covers order[bounds[c] : bounds[c + 1]].
+    n_chunks = max(1, min(n_chunks, len(costs)))
+    loads = [(0.0, c) for c in range(n_chunks)]
+    members = [[] for c in range(n_chunks)]
+    for i in np.argsort(-np.asarray(costs), kind="stable"):
+        load, c = heapq.heappop(loads)
+        members[c].append(i)
+        heapq.heappush(loads, (load + costs[i], c))
+    order = np.array([i for chunk in members for i in chunk], dtype=np.int64)
+    bounds = np.cumsum([0] + [len(chunk) for chunk in members]).astype(np.int64)
+    return order, bounds
+
+
+# # Shards
+#
+# generate_model_data.py --shards also writes the patterns split by household
+# size and number of cases, each (size, cases) pair a complete store in
+# output/shards/<name>/ with a shard.json describing it; households without
+# cases stay in negative_age_totals.npy. The patterns of a shard all cost the
+# same, so each shard can go to whichever engine is cheaper for it, and a fit
+# can leave out the expensive shards altogether. Shards are evaluated one
+# after another, each with its own schedule from cost_balanced_chunks.
+
+
+def load_shards(directory="output/shards"):
+    # Returns the shards, smallest households first, and the members of
+    # households without cases by age code. Each shard is a dict with its
+    # metadata, store and pattern counts.
+    directory = pathlib.Path(directory)
+    with open(directory / "index.json") as f:
+        names = json.load(f)["shards"]
+    shards = []
+    for name in names:
+        with open(directory / name / "shard.json") as f:
+            meta = json.load(f)
+        households, W = load_store(directory / name)
+        shards.append({"meta": meta, "households": households, "W": W})
+    negative_totals = np.load(directory / "negative_age_totals.npy").astype(np.float64)
+    return shards, negative_totals
+
+
+def prepare_shards(shards, nages, n_chunks, engine="auto"):
+    # Gives each shard an engine ("auto" picks the cheaper one for that
+    # shard), the cost of one evaluation of it and a schedule, and returns
+    # the subset tables for the largest number of cases a Ball shard has
+    qmax = 0
+    for shard in shards:
+        sizes, q = shard["households"][4:]
+        costs = {
+            "ball": ball_costs(sizes, q),
+            "exchangeable": exchangeable_costs(shard["households"], nages),
+        }
+        if engine == "auto":
+            shard["engine"] = min(costs, key=lambda e: np.sum(costs[e]))
+        else:
+            shard["engine"] = engine
+        shard["cost"] = float(np.sum(costs[shard["engine"]]))
+        shard["schedule"] = cost_balanced_chunks(costs[shard["engine"]], n_chunks)
+        if shard["engine"] == "ball":
+            qmax = max(qmax, int(np.max(q)))
+    return submask_lattice(qmax)
+
+
+def sharded_nll(x, shards, lattice, negative_totals, nages, add_ridge):
+    # The same negative log likelihood as ball_nll, summed shard by shard;
+    # the ridge and the households without cases are added once
+    nll = total_nll(x, np.zeros(0), np.zeros(0), add_ridge)
+    nll += negatives_nll(x[1], x[4 : (4 + nages)], negative_totals, nages)
+    no_negatives = np.zeros(len(negative_totals))
+    for shard in shards:
+        args = (x, shard["households"], shard["W"], no_negatives, nages, 0.0)
+        if shard["engine"] == "ball":
+            nll += ball_nll(*args, shard["schedule"], lattice)
+        else:
+            nll += exchangeable_nll(*args, shard["schedule"])
+    return nll
+
+
+def sharded_nll_grad(x, shards, lattice, negative_totals, nages, add_ridge):
+    # As sharded_nll, with the gradient
+    nll, grad = total_nll_grad(
+        x, np.zeros(0), np.zeros(0), np.zeros((0, len(x))), add_ridge
+    )
+    nll0, dllaG, dalpha = negatives_nll_grad(
+        x[1], x[4 : (4 + nages)], negative_totals, nages
+    )
+    nll += nll0
+    grad[1] += dllaG
+    grad[4 : (4 + nages)] += dalpha
+    no_negatives = np.zeros(len(negative_totals))
+    for shard in shards:
+        args = (x, shard["households"], shard["W"], no_negatives, nages, 0.0)
+        if shard["engine"] == "ball":
+            shard_nll, shard_grad = ball_nll_grad(*args, shard["schedule"], lattice)
+        else:
+            shard_nll, shard_grad = exchangeable_nll_grad(*args, shard["schedule"])
+        nll += shard_nll
+        grad += shard_grad
+    return nll, grad
+
+
+def sharded_nll_batch(xs, shards, lattice, negative_totals, nages, add_ridge):
+    # As sharded_nll at each row of xs
+    nll = batch_totals(
+        xs, np.zeros(0), np.zeros((len(xs), 0)), negative_totals, nages, add_ridge
+    )
+    no_negatives = np.zeros(len(negative_totals))
+    for shard in shards:
+        args = (xs, shard["households"], shard["W"], no_negatives, nages, 0.0)
+        if shard["engine"] == "ball":
+            nll += ball_nll_batch(*args, shard["schedule"], lattice)
+        else:
+            nll += exchangeable_nll_batch(*args, shard["schedule"])
+    return nll
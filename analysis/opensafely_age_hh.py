@@ -11,13 +11,36 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import logging
 import numba
+import argparse
 import pathlib
 import os
 import sys
 import pickle
+import time
+
+from household_likelihood import (
+    ball_costs,
+    ball_sorted_household_nll,
+    cost_balanced_chunks,
+    household_design,
+    load_households,
+    negatives_nll,
+    phi,
+    submask_lattice,
+    total_nll,
+)
 
+parser = argparse.ArgumentParser()
+parser.add_argument("increase_nll", nargs="?", choices=["increase_nll"])
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=1,
+    help="Number of threads to spread the households over",
+)
+args = parser.parse_args()
 
-increase_nll = len(sys.argv) > 1 and sys.argv[1] == "increase_nll"
+increase_nll = args.increase_nll is not None
 if increase_nll:
     logname = "opensafely_age_hh_with_ridge.log"
 else:
@@ -39,20 +62,20 @@ nages = 2
 
 optimize_maxiter = 1000  #  Reduce to run faster but possibly not solve
 
-increase_nll = len(sys.argv) > 1 and sys.argv[1] == "increase_nll"
-
-with open("output/case_series.pickle", "rb") as f:
-    Y = pickle.load(f)
-with open("output/age_categories_series.pickle", "rb") as f:
-    XX = pickle.load(f)
+# W is the number of households sharing each (case, age) pattern and N0 the
+# members of households without cases, by age code
+households, W, N0 = load_households("output")
 
-XX = numba.typed.List(XX)
-Y = numba.typed.List(Y)
+hhnums = len(W)
+assert hhnums == len(households[2]) - 1
 
-hhnums = len(Y)
-assert hhnums == len(XX)
-
-logging.info("Data pre-processing completed, %s households loaded", hhnums)
+logging.info(
+    "Data pre-processing completed, %s households with cases loaded as %s distinct "
+    "patterns, %s people in households without cases",
+    int(W.sum()),
+    hhnums,
+    int(N0.sum()),
+)
 
 
 # # Define functions
@@ -64,80 +87,44 @@ logging.info("Data pre-processing completed, %s households loaded", hhnums)
 #
 # Note that mynll here does not include a 'dilution' effect with number of household occupants (often called the 'Cauchemez model') and there are many other refinements we might like to consider.
 #
-
-
-@numba.jit(nopython=True)
-def phi(s, logtheta=0.0):
-    theta = np.exp(logtheta)
-    return (1.0 + theta * s) ** (-1.0 / theta)
-
-
-@numba.jit(nopython=True)
-def decimal_to_bit_array(d, n_digits):
-    powers_of_two = int(2) ** np.arange(32)[::-1]
-    return ((d & powers_of_two) / powers_of_two)[-n_digits:]
-
-
-@numba.jit(nopython=True)
-def mynll(x, Y, XX):
-
-    if True:  # Ideally catch the linear algebra fail directly
-        llaL = x[0]
-        llaG = x[1]
-        logtheta = x[2]
-        alpha = x[3 : (3 + nages)]
-        beta = x[(3 + nages) : (3 + 2 * nages)]
-        gamma = x[(3 + 2 * nages) :]
-        nlv = np.zeros(hhnums)  # Vector of negative log likelihoods
-        for i in range(0, hhnums):
-            y = Y[i]
-            # At this point, X is a np.array whose elements are an int
-            # representing the classfication of each household member's age. We
-            # need to turn this into an ndarray whose rows are bitarrays
-            # representating this age.
-            #
-            # To do this in a numba-compliant way, we need to make a
-            #  list-of-lists before casting to an ndarray.
-            X = []
-            for age in XX[i]:
-                X.append(list(decimal_to_bit_array(age, 2)))
-            X = np.array(X)
-
-            if np.all(y == 0):
-                nlv[i] = np.exp(llaG) * np.sum(np.exp(alpha @ (X.T)))
-            else:
-                # Sort to go zeros then ones WLOG (could do in pre-processing)
-                ii = np.argsort(y)
-                y = y[ii]
-                X = X[ii, :]
-                q = np.sum(y > 0)
-                r = 2 ** q
-                m = len(y)
-
-                # Quantities that don't vary through the sum
-                Bk = np.exp(-np.exp(llaG) * np.exp(alpha @ (X.T)))
-                laM = np.exp(llaL) * np.outer(
-                    np.exp(beta @ (X.T)), np.exp(gamma @ (X.T))
-                )
-
-                BB = np.zeros((r, r))  # To be the Ball matrix
-                for jd in range(0, r):
-                    j = decimal_to_bit_array(jd, m)
-                    for omd in range(0, jd + 1):
-                        om = decimal_to_bit_array(omd, m)
-                        if np.all(om <= j):
-                            BB[jd, omd] = 1.0 / np.prod(
-                                (phi((1 - j) @ laM, logtheta) ** om) * (Bk ** (1 - j))
-                            )
-                nlv[i] = -np.log(LA.solve(BB, np.ones(r))[-1])
-        nll = np.sum(nlv)
-        if increase_nll:
-            nll += 7.4 * np.sum(x ** 2)  # Comment out this Ridge if not needed
-
-        return nll
-    else:
-        nll = np.inf
-        return nll
+# Both come from household_likelihood.py; households are dealt out to the
+# threads in chunks of similar expected cost.
+
+numba.set_num_threads(args.threads)
+sizes, q = households[4:]
+costs = ball_costs(sizes, q)
+schedule = cost_balanced_chunks(costs, 4 * args.threads)
+lattice = submask_lattice(int(np.max(q)))
+
+
+# Ridge penalty on the parameters, if requested
+add_ridge = 7.4 if increase_nll else 0.0
+
+
+@numba.jit(nopython=True, parallel=True, cache=True)
+def nll_kernel(x, households, W, N0, nages, add_ridge, schedule, lattice):
+    order, bounds = schedule
+    llaL = x[0]
+    llaG = x[1]
+    logtheta = x[2]
+    alpha = x[3 : (3 + nages)]
+    beta = x[(3 + nages) : (3 + 2 * nages)]
+    gamma = x[(3 + 2 * nages) :]
+    nlv = np.zeros(len(W))  # Vector of negative log likelihoods per pattern
+    for c in numba.prange(len(bounds) - 1):
+        for t in range(bounds[c], bounds[c + 1]):
+            i = order[t]
+            q, X = household_design(households, i)
+            # No Cauchemez term, so eta = 0
+            nlv[i] = ball_sorted_household_nll(
+                q, X, lattice, llaL, llaG, logtheta, 0.0, alpha, beta, gamma
+            )
+    nll = negatives_nll(llaG, alpha, N0, nages)
+    return nll + total_nll(x, W, nlv, add_ridge)
+
+
+def mynll(x, households, W):
+    return nll_kernel(x, households, W, N0, nages, add_ridge, schedule, lattice)
 
 
 logging.info("Helper functions defined")
@@ -164,10 +151,14 @@ x0 = np.array(
         0.0,
     ]
 )
-mynll(x0, Y, XX)
+start = time.perf_counter()
+mynll(x0, households, W)
 
 
-logging.info("Objective function evaluated at one value")
+logging.info(
+    "Objective function evaluated at one value, startup took %.1f s",
+    time.perf_counter() - start,
+)
 
 
 def callbackF(x):
@@ -194,7 +185,7 @@ bb = np.array(
 fout = op.minimize(
     mynll,
     x0,
-    (Y, XX),
+    (households, W),
     bounds=bb,
     method="TNC",
     callback=callbackF,
@@ -218,18 +209,18 @@ for j in range(0, pn):
     for k in range(0, j):
         ek[k] = dx[k]
         Hinv[j, k] = (
-            mynll(xhat + ej + ek, Y, XX)
-            - mynll(xhat + ej - ek, Y, XX)
-            - mynll(xhat - ej + ek, Y, XX)
-            + mynll(xhat - ej - ek, Y, XX)
+            mynll(xhat + ej + ek, households, W)
+            - mynll(xhat + ej - ek, households, W)
+            - mynll(xhat - ej + ek, households, W)
+            + mynll(xhat - ej - ek, households, W)
         )
         ek[k] = 0.0
     Hinv[j, j] = (
-        -mynll(xhat + 2 * ej, Y, XX)
-        + 16 * mynll(xhat + ej, Y, XX)
-        - 30 * mynll(xhat, Y, XX)
-        + 16 * mynll(xhat - ej, Y, XX)
-        - mynll(xhat - 2 * ej, Y, XX)
+        -mynll(xhat + 2 * ej, households, W)
+        + 16 * mynll(xhat + ej, households, W)
+        - 30 * mynll(xhat, households, W)
+        + 16 * mynll(xhat - ej, households, W)
+        - mynll(xhat - 2 * ej, households, W)
     )
     ej[j] = 0.0
 Hinv += np.triu(Hinv.T, 1)
@@ -16,10 +16,43 @@ import seaborn as sns
 import logging
 import numba
 import argparse
+import json
+import multiprocessing
 import pathlib
 import os
 import sys
 import pickle
+import time
+
+from checkpoints import (
+    checkpointed,
+    load_checkpoint,
+    new_checkpoint,
+    save_checkpoint,
+    set_rng_state,
+)
+from fit_registry import data_digest, nearest_fit, record_fit
+from hessian import covariance_from_hessian, finite_difference_hessian
+from household_likelihood import (
+    ball_costs,
+    ball_nll,
+    ball_nll_batch,
+    ball_nll_grad,
+    cost_balanced_chunks,
+    exchangeable_costs,
+    exchangeable_nll,
+    exchangeable_nll_batch,
+    exchangeable_nll_grad,
+    kernel_cache_hits,
+    load_households,
+    load_shards,
+    phi,
+    prepare_shards,
+    sharded_nll,
+    sharded_nll_batch,
+    sharded_nll_grad,
+    submask_lattice,
+)
 
 optimize_maxiter = 1000  #  Reduce to run faster but possibly not solve
 
@@ -47,24 +80,119 @@ bb = np.array(
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--add-ridge", type=float, default=0.0)
-parser.add_argument("--starting-parameter", type=int)
+parser.add_argument(
+    "--starting-parameter",
+    type=int,
+    nargs="+",
+    help="Seeds of random starting parameters; with several, one fit is run "
+    "from each and the best taken",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=1,
+    help="Number of processes to run the fits from different starts in",
+)
+parser.add_argument(
+    "--engine",
+    choices=["ball", "exchangeable", "auto"],
+    default="ball",
+    help="Likelihood engine: full Ball matrix, or recursion over per-age-class counts; "
+    "with --shards, auto takes the cheaper of the two for each shard",
+)
+parser.add_argument(
+    "--check-engines",
+    action="store_true",
+    help="Compare both likelihood engines at the starting parameters and exit; "
+    "both lose precision alike, which check_precision.py tests against an exact reference",
+)
+parser.add_argument(
+    "--threads",
+    type=int,
+    default=1,
+    help="Number of threads to spread the households over",
+)
+parser.add_argument(
+    "--numerical-gradient",
+    action="store_true",
+    help="Let the optimiser estimate the gradient by finite differences",
+)
+parser.add_argument(
+    "--shards",
+    action="store_true",
+    help="Fit to the shards written by generate_model_data.py --shards",
+)
+parser.add_argument(
+    "--max-shard-cases",
+    type=int,
+    help="Leave out the shards of households with more cases than this",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Carry on from the checkpoints of an earlier run with the same arguments",
+)
+parser.add_argument(
+    "--checkpoint-every",
+    type=float,
+    default=60.0,
+    help="Seconds between checkpoints of each fit",
+)
+parser.add_argument(
+    "--race",
+    action="store_true",
+    help="Race the starts: give each a few evaluations, keep the best and repeat "
+    "with more, then fit the survivors in full",
+)
+parser.add_argument(
+    "--race-evaluations",
+    type=int,
+    default=10,
+    help="Evaluations given to every start in the first round of the race",
+)
+parser.add_argument(
+    "--race-keep",
+    type=float,
+    default=0.5,
+    help="Fraction of the starts kept after each round of the race",
+)
+parser.add_argument(
+    "--warm-start",
+    action="store_true",
+    help="Start from the optimum of the previous fit of this model to the nearest "
+    "data, and draw the seeded starts around it",
+)
 args = parser.parse_args()
+if args.engine == "auto" and not args.shards:
+    parser.error("--engine auto needs --shards")
+if args.max_shard_cases is not None and not args.shards:
+    parser.error("--max-shard-cases needs --shards")
+if args.check_engines and args.shards:
+    parser.error("--check-engines works on the whole store, not on --shards")
+if not 0.0 < args.race_keep < 1.0:
+    parser.error("--race-keep must be between 0 and 1")
 
 ridgestr = str(args.add_ridge).replace('.','_')
-if args.starting_parameter:
-    logname = (
-        f"opensafely_age_hh_ridge_{ridgestr}_and_seed_{args.starting_parameter}.log"
-    )
+if args.starting_parameter and len(args.starting_parameter) > 1:
+    logname = f"opensafely_age_hh_ridge_{ridgestr}_multistart.log"
+elif args.starting_parameter:
+    seed = args.starting_parameter[0]
+    logname = f"opensafely_age_hh_ridge_{ridgestr}_and_seed_{seed}.log"
 else:
     logname = f"opensafely_age_hh_ridge_{ridgestr}_midpoint_start.log"
 
 add_ridge = float(args.add_ridge)  # To keep numba JIT happy
 
 if args.starting_parameter:
-    np.random.seed(args.starting_parameter)
-    x0 = np.random.uniform(bb[:,0],bb[:,1])
+    x0s = []
+    for seed in args.starting_parameter:
+        np.random.seed(seed)
+        x0s.append(np.random.uniform(bb[:,0],bb[:,1]))
+    seeds = list(args.starting_parameter)
 else:
-    x0 = np.mean(bb,1)
+    x0s = [np.mean(bb,1)]
+    seeds = [None]
+x0 = x0s[0]
 
 homedir = pathlib.Path(__file__).resolve().parent.parent
 
@@ -76,118 +204,195 @@ logging.basicConfig(
 )
 logging.info("Libraries imported and logging started")
 
-logging.info("Starting parameters: %s", x0)
-
-with open("output/case_series.pickle", "rb") as f:
-    Y = pickle.load(f)
-with open("output/age_categories_series.pickle", "rb") as f:
-    XX = pickle.load(f)
-
-XX = numba.typed.List(XX)
-Y = numba.typed.List(Y)
-
-hhnums = len(Y)
-assert hhnums == len(XX)
+for x0_start in x0s:
+    logging.info("Starting parameters: %s", x0_start)
+
+# W is the number of households sharing each (case, age) pattern and N0 the
+# members of households without cases, by age code
+if args.shards:
+    # A list of stores, one for each household size and number of cases, each
+    # carrying its own W
+    households, N0 = load_shards("output/shards")
+    if args.max_shard_cases is not None:
+        households = [
+            shard
+            for shard in households
+            if shard["meta"]["cases"] <= args.max_shard_cases
+        ]
+    W = None
+    counts = [shard["W"] for shard in households]
+    hhnums = sum(len(w) for w in counts)
+    n_households = sum(int(w.sum()) for w in counts)
+else:
+    households, W, N0 = load_households("output")
+    hhnums = len(W)
+    assert hhnums == len(households[2]) - 1
+    n_households = int(W.sum())
 
-logging.info("Data pre-processing completed, %s households loaded", hhnums)
+logging.info(
+    "Data pre-processing completed, %s households with cases loaded as %s distinct "
+    "patterns, %s people in households without cases",
+    n_households,
+    hhnums,
+    int(N0.sum()),
+)
 
 
 # # Define functions
 #
-# We need two functions:
+# The likelihood engines live in household_likelihood.py:
 #
 # * phi is the Laplace transform of the distribution of heterogeneity in transmissibility
-# * mynll is the negative log likelihood function for the model
-
-
-@numba.jit(nopython=True)
-def phi(s, logtheta=0.0):
-    theta = np.exp(logtheta)
-    return (1.0 + theta * s) ** (-1.0 / theta)
-
-
-@numba.jit(nopython=True)
-def decimal_to_bit_array(d, n_digits):
-    powers_of_two = int(2) ** np.arange(32)[::-1]
-    return ((d & powers_of_two) / powers_of_two)[-n_digits:]
-
-
-@numba.jit(nopython=True)
-def mynll(x, Y, XX):
-    # This is the number of age classes; here we will follow Roz's interests and consider two young ages
-    nages = 2
-    if True:  # Ideally catch the linear algebra fail directly
-        llaL = x[0]
-        llaG = x[1]
-        logtheta = x[2]
-        eta = (4.0 / np.pi) * np.arctan(x[3])
-        alpha = x[4 : (4 + nages)]
-        beta = x[(4 + nages) : (4 + 2 * nages)]
-        gamma = x[(4 + 2 * nages) :]
-
-        nlv = np.zeros(hhnums)  # Vector of negative log likelihoods
-        for i in range(0, hhnums):
-            y = Y[i]
-            # At this point, X is a np.array whose elements are an int
-            # representing the classfication of each household member's age. We
-            # need to turn this into an ndarray whose rows are bitarrays
-            # representating this age.
-            #
-            # To do this in a numba-compliant way, we need to make a
-            #  list-of-lists before casting to an ndarray.
-            X = []
-            for age in XX[i]:
-                X.append(list(decimal_to_bit_array(age, 2)))
-            X = np.array(X)
-
-            if np.all(y == 0):
-                nlv[i] = np.exp(llaG) * np.sum(np.exp(alpha @ (X.T)))
-            else:
-                # Sort to go zeros then ones WLOG (could do in pre-processing)
-                ii = np.argsort(y)
-                y = y[ii]
-                X = X[ii, :]
-                q = np.sum(y > 0)
-                r = 2 ** q
-                m = len(y)
-
-                # Quantities that don't vary through the sum
-                Bk = np.exp(-np.exp(llaG) * np.exp(alpha @ (X.T)))
-                laM = (
-                    np.exp(llaL)
-                    * np.outer(np.exp(beta @ (X.T)), np.exp(gamma @ (X.T)))
-                    * (m ** eta)
-                )
-
-                BB = np.zeros((r, r))  # To be the Ball matrix
-                for jd in range(0, r):
-                    j = decimal_to_bit_array(jd, m)
-                    for omd in range(0, jd + 1):
-                        om = decimal_to_bit_array(omd, m)
-                        if np.all(om <= j):
-                            # devide by zero encountered in double_scalars
-                            # overflow encountered in double_scalars
-                            my_phi = phi((1 - j) @ laM, logtheta)
-
-                            if np.any(
-                                np.floor(np.log10(np.abs(my_phi[my_phi != 0]))) < -100
-                            ):
-                                return np.inf
-
-                            BB[jd, omd] = 1.0 / np.prod(
-                                (my_phi ** om) * (Bk ** (1 - j))
-                            )
-                if np.any(np.isnan(BB)) or np.any(np.isinf(BB)):
-                    return np.inf
-                nlv[i] = -np.log(LA.solve(BB, np.ones(r))[-1])
-        nll = np.sum(nlv)
-        nll += add_ridge * np.sum(x ** 2)
-        return nll
+# * ball_nll and exchangeable_nll are equivalent negative log likelihoods for the model;
+#   the exchangeable engine groups household members by age class and scales to
+#   much larger households
+
+# This is the number of age classes; here we will follow Roz's interests and consider two young ages
+nages = 2
+
+# Converged fits are recorded in output/fit_registry.jsonl under a hash of the
+# model data, the model variant and the bounds, for later fits to warm-start
+# from. With --shards that is the shard files fitted to, not the store.
+if args.shards:
+    data_paths = ["output/shards/index.json"]
+    for shard in households:
+        directory = pathlib.Path("output/shards") / shard["meta"]["name"]
+        data_paths += [directory / "shard.json"] + sorted(directory.glob("*.npy"))
+    data_paths.append("output/shards/negative_age_totals.npy")
+else:
+    data_paths = [
+        f"output/{name}.npy"
+        for name in [
+            "household_cases",
+            "household_ages",
+            "household_offsets",
+            "household_counts",
+            "negative_age_totals",
+        ]
+    ]
+data_sha256 = data_digest(data_paths)
+data_summary = {
+    "households": n_households,
+    "patterns": hhnums,
+    "negative_age_totals": N0.tolist(),
+}
+variant = {
+    "model": "opensafely_age_hh_th",
+    "nages": nages,
+    "add_ridge": add_ridge,
+    "cauchemez": True,
+    "max_shard_cases": args.max_shard_cases,
+}
+warm_start = None
+if args.warm_start:
+    warm_start = nearest_fit(data_sha256, data_summary, variant, bb.tolist())
+if warm_start is not None:
+    # The previous optimum is the first start; the seeded starts are drawn
+    # around it from its covariance, if that is usable, or from bb as usual
+    xprev = np.clip(warm_start["x"], bb[:, 0], bb[:, 1])
+    cov = warm_start["covariance"]
+    if args.starting_parameter and cov is not None and np.all(LA.eigvalsh(cov) > 0.0):
+        x0s = []
+        for seed in args.starting_parameter:
+            np.random.seed(seed)
+            draw = np.random.multivariate_normal(xprev, cov)
+            x0s.append(np.clip(draw, bb[:, 0], bb[:, 1]))
+    elif not args.starting_parameter:
+        x0s, seeds = [], []
+    x0s = [xprev] + x0s
+    seeds = [None] + seeds
+    x0 = x0s[0]
+    logging.info(
+        "Warm start from the fit recorded at %s (%s), value %s, data %s",
+        warm_start["recorded_at"],
+        warm_start["log"],
+        warm_start["fun"],
+        "unchanged" if warm_start["data_sha256"] == data_sha256 else "changed",
+    )
+    for x0_start in x0s:
+        logging.info("Starting parameters: %s", x0_start)
+elif args.warm_start:
+    logging.info("No previous fit to warm-start from")
+
+# Households are dealt out to the threads in chunks of similar expected cost;
+# a few chunks per thread leaves some slack for the threading layer
+if args.processes > 1:
+    # Fits from several starts run in forked processes (below); the TBB layer
+    # hangs the parent at exit once it has forked and GNU OpenMP refuses to
+    # fork at all, while the workqueue layer is safe to fork
+    numba.config.THREADING_LAYER = "workqueue"
+numba.set_num_threads(args.threads)
+if args.shards:
+    # Each shard gets its own engine and schedule, and the subset tables cover
+    # the shards that use the Ball engine
+    lattice = prepare_shards(households, nages, 4 * args.threads, args.engine)
+    for shard in households:
+        logging.info(
+            "Shard %s: %s patterns, %s engine, cost %.3g",
+            shard["meta"]["name"],
+            shard["meta"]["patterns"],
+            shard["engine"],
+            shard["cost"],
+        )
+else:
+    sizes, q = households[4:]
+    if args.engine == "ball":
+        costs = ball_costs(sizes, q)
     else:
-        nll = np.inf
-        return nll
+        costs = exchangeable_costs(households, nages)
+    schedule = cost_balanced_chunks(costs, 4 * args.threads)
+
+    # Subset tables for the Ball engine; these grow as 3^q in the largest
+    # number of cases q in one household, so only build them when they are used
+    if args.engine == "ball" or args.check_engines:
+        lattice = submask_lattice(int(np.max(q)))
+
+    logging.info(
+        "Using the %s engine on %s threads, %s chunks",
+        args.engine,
+        args.threads,
+        len(schedule[1]) - 1,
+    )
 
 
+def mynll(x, households, W):
+    if args.shards:
+        return sharded_nll(x, households, lattice, N0, nages, add_ridge)
+    if args.engine == "ball":
+        return ball_nll(x, households, W, N0, nages, add_ridge, schedule, lattice)
+    return exchangeable_nll(x, households, W, N0, nages, add_ridge, schedule)
+
+
+def mynll_and_grad(x, households, W):
+    # Same as mynll, along with its exact gradient
+    if args.shards:
+        return sharded_nll_grad(x, households, lattice, N0, nages, add_ridge)
+    if args.engine == "ball":
+        return ball_nll_grad(x, households, W, N0, nages, add_ridge, schedule, lattice)
+    return exchangeable_nll_grad(x, households, W, N0, nages, add_ridge, schedule)
+
+
+def mynll_batch(xs, households, W):
+    # mynll at each row of xs
+    if args.shards:
+        return sharded_nll_batch(xs, households, lattice, N0, nages, add_ridge)
+    if args.engine == "ball":
+        return ball_nll_batch(xs, households, W, N0, nages, add_ridge, schedule, lattice)
+    return exchangeable_nll_batch(xs, households, W, N0, nages, add_ridge, schedule)
+
+
+if args.check_engines:
+    nll_ball = ball_nll(x0, households, W, N0, nages, add_ridge, schedule, lattice)
+    nll_exchangeable = exchangeable_nll(x0, households, W, N0, nages, add_ridge, schedule)
+    rel_diff = abs(nll_ball - nll_exchangeable) / abs(nll_ball)
+    logging.info(
+        "Ball engine: %s, exchangeable engine: %s, relative difference %.3e",
+        nll_ball,
+        nll_exchangeable,
+        rel_diff,
+    )
+    sys.exit(0 if rel_diff < 1e-8 else 1)
+
 logging.info("Helper functions defined")
 
 
@@ -197,9 +402,22 @@ logging.info("Helper functions defined")
 #
 
 
-mynll(x0, Y, XX)
-
-logging.info("Objective function evaluated at one value")
+# The first evaluations load the kernels from the cache written by
+# compile_kernels.py, or compile them if it is missing or out of date
+start = time.perf_counter()
+mynll(x0, households, W)
+if not args.numerical_gradient:
+    mynll_and_grad(x0, households, W)
+hits, misses = kernel_cache_hits(
+    ball_nll, ball_nll_grad, exchangeable_nll, exchangeable_nll_grad
+)
+logging.info(
+    "Objective function evaluated at one value, startup took %.1f s "
+    "(%s kernels loaded from cache, %s compiled)",
+    time.perf_counter() - start,
+    hits,
+    misses,
+)
 
 
 def callbackF(x):
@@ -209,15 +427,233 @@ def callbackF(x):
 
 # First try from (essentially) the origin using Nelder-Mead
 # The exact optimisation method to use is expected to depend a lot on the actual data
-fout = op.minimize(
-    mynll,
-    x0,
-    (Y, XX),
-    bounds=bb,
-    method="TNC",
-    callback=callbackF,
-    options={"maxiter": optimize_maxiter, "ftol": 1e-4},
+# With the exact gradient each iteration costs one evaluation rather than
+# one per parameter
+if args.numerical_gradient:
+    objective, jac = mynll, None
+else:
+    objective, jac = mynll_and_grad, True
+
+
+# Each fit is checkpointed to its own file under output/checkpoints, so a run
+# that is killed can be resumed with --resume; fits that had finished are not
+# run again
+checkpoint_dir = homedir / "output" / "checkpoints" / logname.replace(".log", "")
+
+
+def matches_checkpoint(state, x0):
+    # Whether state is the checkpoint of a fit from x0 to this model data
+    # with this model variant; the name of the log leaves out the data, and
+    # some of the options that change the model, such as --max-shard-cases
+    return (
+        np.array_equal(state["x0"], x0)
+        and state.get("data_sha256") == data_sha256
+        and state.get("variant") == variant
+    )
+
+
+def fit(i, maxfun=None, resume=args.resume):
+    # Fits from start i, stopping once maxfun evaluations have been spent on
+    # it in total if maxfun is given; a fit stopped that way is left
+    # unfinished in its checkpoint, to be carried on with resume
+    path = checkpoint_dir / f"start_{i}.json"
+    state = load_checkpoint(path) if resume else None
+    if state is not None and not matches_checkpoint(state, x0s[i]):
+        logging.info(
+            "Ignoring checkpoint %s from other starting parameters, model data "
+            "or model variant",
+            path,
+        )
+        state = None
+    if state is None:
+        state = new_checkpoint(x0s[i], data_sha256, variant)
+    else:
+        set_rng_state(state["rng_state"])
+        if state["result"] is not None:
+            logging.info("Fit from start %s already finished, see %s", i, path)
+            result = state["result"]
+            return op.OptimizeResult(
+                {
+                    **result,
+                    "x": np.array(result["x"]),
+                    "jac": np.array(result["jac"]),
+                    "finished_before": True,
+                }
+            )
+        logging.info(
+            "Resuming fit from start %s after %s iterations and %s evaluations, "
+            "best value so far %s",
+            i,
+            state["nit"],
+            state["nfev"],
+            state["best_fun"],
+        )
+    nit, nfev = state["nit"], state["nfev"]
+    counted_objective, callback = checkpointed(
+        objective, path, state, args.checkpoint_every, callbackF
+    )
+    options = {"maxiter": optimize_maxiter, "ftol": 1e-4}
+    if maxfun is not None:
+        options["maxfun"] = max(1, maxfun - nfev)
+    fout = op.minimize(
+        counted_objective,
+        np.array(state["x"]),
+        (households, W),
+        jac=jac,
+        bounds=bb,
+        method="TNC",
+        callback=callback,
+        options=options,
+    )
+    # Count the work done before the run was resumed too
+    fout.nit += nit
+    fout.nfev += nfev
+    if maxfun is not None and fout.status == 3:
+        # Out of evaluations rather than converged
+        state["x"] = fout.x.tolist()
+        save_checkpoint(path, state)
+        return fout
+    state["result"] = {
+        "x": fout.x.tolist(),
+        "fun": float(fout.fun),
+        "jac": np.asarray(fout.jac).tolist(),
+        "nit": int(fout.nit),
+        "nfev": int(fout.nfev),
+        "status": int(fout.status),
+        "success": bool(fout.success),
+        "message": str(fout.message),
+    }
+    save_checkpoint(path, state)
+    return fout
+
+
+# Several starts are fitted in forked processes, which share the loaded
+# households and the compiled kernels with this one; each process still runs
+# the kernels on --threads threads
+def fit_starts(starts, maxfun=None, resume=args.resume):
+    if len(starts) > 1 and args.processes > 1:
+        with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+            jobs = [(i, maxfun, resume) for i in starts]
+            return pool.starmap(fit, jobs, chunksize=1)
+    return [fit(i, maxfun, resume) for i in starts]
+
+
+def final_value(fout):
+    return fout.fun if np.isfinite(fout.fun) else np.inf
+
+
+def keep_fit(i, fout):
+    # A start that finished in an earlier round comes back from its
+    # checkpoint in later ones, as though finished by an earlier run, so the
+    # fit is kept as it was made
+    if fouts[i] is None or fouts[i].status == 3:
+        fouts[i] = fout
+
+
+# Successive halving: every start gets a small number of evaluations, the
+# best fraction of them by the value they have reached carries on with
+# proportionally more, and so on until one round would leave a single start.
+# The survivors are then fitted to convergence, while starts that were
+# dropped keep the value they had reached.
+start = time.perf_counter()
+fouts = [None] * len(x0s)
+starts = list(range(len(x0s)))
+race = []
+if args.race:
+    maxfun = args.race_evaluations
+    resume = args.resume
+    while int(len(starts) * args.race_keep) >= 1:
+        for i, fout in zip(starts, fit_starts(starts, maxfun, resume)):
+            keep_fit(i, fout)
+        starts.sort(key=lambda i: final_value(fouts[i]))
+        n_keep = int(len(starts) * args.race_keep)
+        race.append(
+            {
+                "evaluations": maxfun,
+                "starts": list(starts),
+                "values": [float(fouts[i].fun) for i in starts],
+                "kept": n_keep,
+            }
+        )
+        logging.info(
+            "Race round %s: %s starts on %s evaluations each, best value %s, "
+            "keeping %s",
+            len(race),
+            len(starts),
+            maxfun,
+            fouts[starts[0]].fun,
+            n_keep,
+        )
+        starts = starts[:n_keep]
+        maxfun = int(np.ceil(maxfun / args.race_keep))
+        resume = True
+    for i, fout in zip(starts, fit_starts(starts, resume=resume)):
+        keep_fit(i, fout)
+else:
+    fouts = fit_starts(starts)
+logging.info(
+    "%s fits in %.1f s on %s processes, %s evaluations in all",
+    len(fouts),
+    time.perf_counter() - start,
+    min(args.processes, len(x0s)),
+    sum(int(fout.nfev) for fout in fouts),
 )
+
+# Fits that end within optimum_tol of each other in every parameter are taken
+# to have found the same local optimum
+optimum_tol = 1e-2
+converged = [
+    i for i, fout in enumerate(fouts) if fout.success and np.isfinite(fout.fun)
+]
+optima = []
+for i in sorted(converged, key=lambda i: fouts[i].fun):
+    for optimum in optima:
+        if np.max(np.abs(fouts[i].x - fouts[optimum[0]].x)) < optimum_tol:
+            optimum.append(i)
+            break
+    else:
+        optima.append([i])
+best = optima[0][0] if optima else int(np.argmin([fout.fun for fout in fouts]))
+
+results = {
+    "fits": [
+        {
+            "seed": seeds[i],
+            "x0": x0s[i].tolist(),
+            "x": fout.x.tolist(),
+            "fun": float(fout.fun),
+            "nfev": int(fout.nfev),
+            "nit": int(fout.nit),
+            "success": bool(fout.success),
+            "message": str(fout.message),
+        }
+        for i, fout in enumerate(fouts)
+    ],
+    "best": best,
+    "warm_start": warm_start and {
+        key: warm_start[key] for key in ["recorded_at", "log", "fun", "data_sha256"]
+    },
+    "race": race,
+    "local_optima": [
+        {
+            "x": fouts[optimum[0]].x.tolist(),
+            "fun": float(fouts[optimum[0]].fun),
+            "seeds": [seeds[i] for i in optimum],
+        }
+        for optimum in optima
+    ],
+}
+with open(homedir / logname.replace(".log", ".json"), "w") as f:
+    json.dump(results, f, indent=2)
+logging.info(
+    "%s of %s fits converged, to %s distinct optima; best from starting parameters %s",
+    len(converged),
+    len(fouts),
+    len(optima),
+    x0s[best],
+)
+
+fout = fouts[best]
 xhat = fout.x
 logging.info(fout)
 if not fout.success:
@@ -225,44 +661,46 @@ if not fout.success:
     sys.exit(0)
 
 
-pn = len(x0)
 delta = 1e-3  # This finite difference needs some unavoidable tuning by hand
 dx = delta * xhat
-ej = np.zeros(pn)
-ek = np.zeros(pn)
-Hinv = np.zeros((pn, pn))
-for j in range(0, pn):
-    ej[j] = dx[j]
-    for k in range(0, j):
-        ek[k] = dx[k]
-        Hinv[j, k] = (
-            mynll(xhat + ej + ek, Y, XX)
-            - mynll(xhat + ej - ek, Y, XX)
-            - mynll(xhat - ej + ek, Y, XX)
-            + mynll(xhat - ej - ek, Y, XX)
-        )
-        ek[k] = 0.0
-    Hinv[j, j] = (
-        -mynll(xhat + 2 * ej, Y, XX)
-        + 16 * mynll(xhat + ej, Y, XX)
-        - 30 * mynll(xhat, Y, XX)
-        + 16 * mynll(xhat - ej, Y, XX)
-        - mynll(xhat - 2 * ej, Y, XX)
-    )
-    ej[j] = 0.0
-Hinv += np.triu(Hinv.T, 1)
+# Every distinct point of the finite difference stencil is evaluated in one
+# pass over the households.
 # We get some divide by zero warnings here. Investigate with
 # np.seterr(all=None, divide=None, over=None, under=None, invalid="raise")
-Hinv = Hinv / (
-    4.0 * np.outer(dx, dx) + np.diag(8.0 * dx ** 2)
-)  # TO DO: replace with a chol ...
+Hinv = finite_difference_hessian(
+    lambda xs: mynll_batch(xs, households, W), xhat, dx, batch=True
+)
+
+
+def register_fit(covariance):
+    # A fit taken finished from its checkpoint was registered by the run that
+    # made it
+    if fout.get("finished_before", False):
+        logging.info("Fit not registered again: it was made by an earlier run")
+        return
+    record_fit(
+        {
+            "data_sha256": data_sha256,
+            "data_summary": data_summary,
+            "variant": variant,
+            "bounds": bb.tolist(),
+            "x": xhat.tolist(),
+            "fun": float(fout.fun),
+            "covariance": covariance,
+            "log": logname,
+        }
+    )
+
+
 try:
-    covmat = LA.inv(0.5 * (Hinv + Hinv.T))
+    covmat = covariance_from_hessian(Hinv)
 except np.linalg.LinAlgError:
     logging.warn("Matrix is singular or ill-conditioned. Exiting. %s", Hinv + Hinv.T)
+    register_fit(None)
     import sys
 
     sys.exit(0)
+register_fit(covmat.tolist())
 stds = np.sqrt(np.diag(covmat))
 
 
@@ -293,6 +731,9 @@ for k in range(2, 7):
             logging.info("Unable to compute baseline p({:d}), got: {!r}".format(k, e))
         else:
             raise
+    except ZeroDivisionError as e:
+        # theta = exp(logtheta) underflows for draws far into the tail
+        logging.info("Unable to compute baseline p({:d}), got: {!r}".format(k, e))
     else:
         eta = (4.0 / np.pi) * np.arctan(xhat[3])
         logging.info(
@@ -1,20 +1,20 @@
 action_template = """
-  run_model_{ridus}_{seed}:
-    run: python:latest python analysis/opensafely_age_hh_th.py --starting-parameter {seed} --add-ridge {rid}
-    needs: [generate_model_data]
+  run_model_{ridus}:
+    run: python:latest python analysis/opensafely_age_hh_th.py --starting-parameter {seeds} --processes {processes} --add-ridge {rid}
+    needs: [generate_model_data, compile_kernels]
     outputs:
       moderately_sensitive:
-        log: opensafely_age_hh_ridge_{ridus}_and_seed_{seed}.log
+        log: opensafely_age_hh_ridge_{ridus}_multistart.log
+        results: opensafely_age_hh_ridge_{ridus}_multistart.json
 """
 
- 
+
 seeds = [ 1, 3, 5, 81, 83, 85, 23, 37, 42, 13 ]
 ridges = [ 20.1 ]
 
-for s in seeds:
-    for r in ridges:
-        print(action_template.format(seed = s, rid = r, ridus = str(r).replace('.','_')))
- 
-for s in seeds:
-    for r in ridges:
-        print("run_model_{ridus}_{seed},".format(seed = s, rid = r, ridus = str(r).replace('.','_')))
+# One action per ridge fits from all the seeds, one process per seed
+for r in ridges:
+    print(action_template.format(seeds = " ".join(str(s) for s in seeds), processes = len(seeds), rid = r, ridus = str(r).replace('.','_')))
+
+for r in ridges:
+    print("run_model_{ridus},".format(rid = r, ridus = str(r).replace('.','_')))